@@ -0,0 +1,385 @@
+"""
+ * This file is part of Telegram Archiver downloader (https://github.dev/opZywl/TelegramArchiver)
+ *
+ *
+ * Telegram Archiver downloader is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * Telegram Archiver downloader is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with Telegram Archiver downloader. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+# Benchmark offline: um cliente simulado no lugar do TelegramClient (histórico sintético, banda e RTT por
+# conexão, FloodWaits injetados) passando pelo caminho real de baixar_todas_midias/baixar_arquivo.
+#
+#   python src/benchmark.py --messages 2000 --rtt-ms 80 --bandwidth-mbps 4 --flood-rate 0.01
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import math
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from telethon.errors import FloodWaitError
+from telethon.tl.types import (
+    Channel,
+    ChatPhotoEmpty,
+    Document,
+    DocumentAttributeFilename,
+    InputMessagesFilterDocument,
+    InputMessagesFilterMusic,
+    InputMessagesFilterPhotos,
+    InputMessagesFilterPhotoVideo,
+    InputMessagesFilterVideo,
+    InputMessagesFilterVoice,
+    Photo,
+)
+
+TAMANHO_BLOCO = 128 * 1024  # tamanho das requisições do download_media simulado
+TIPOS = {
+    "photos": ("image/jpeg", ".jpg"),
+    "videos": ("video/mp4", ".mp4"),
+    "documents": ("application/pdf", ".pdf"),
+}
+# Tipos do histórico simulado que cada filtro de busca (messages.search) devolve
+TIPOS_POR_FILTRO = {
+    InputMessagesFilterPhotos: {"photos"},
+    InputMessagesFilterVideo: {"videos"},
+    InputMessagesFilterPhotoVideo: {"photos", "videos"},
+    InputMessagesFilterDocument: {"documents"},
+    InputMessagesFilterMusic: set(),
+    InputMessagesFilterVoice: set(),
+}
+
+
+class ArquivoSimulado:
+    # O que o código real lê de message.file
+    def __init__(self, name, ext, mime_type, size):
+        self.name = name
+        self.ext = ext
+        self.mime_type = mime_type
+        self.size = size
+
+
+class MensagemSimulada:
+    def __init__(self, client, message_id, date, tipo=None, media_id=None, size=0):
+        self.client = client
+        self.id = message_id
+        self.date = date
+        self.tipo = tipo
+        self.input_chat = None
+        self.photo = self.video = self.audio = self.voice = self.document = None
+        self.media = self.file = None
+        if tipo is None:
+            return
+        mime_type, ext = TIPOS[tipo]
+        if tipo == "photos":
+            self.photo = Photo(id=media_id, access_hash=1, file_reference=b"", date=date, sizes=[], dc_id=1)
+            self.media = self.photo
+            self.file = ArquivoSimulado(None, ext, mime_type, size)
+        else:
+            name = f"{tipo}_{media_id}{ext}"
+            self.document = Document(
+                id=media_id, access_hash=1, file_reference=b"", date=date, mime_type=mime_type, size=size,
+                dc_id=1, attributes=[DocumentAttributeFilename(name)],
+            )
+            self.media = self.document
+            self.video = self.document if tipo == "videos" else None
+            self.file = ArquivoSimulado(name, ext, mime_type, size)
+
+    async def download_media(self, file=None, progress_callback=None):
+        return await self.client.download_media(self, file, progress_callback)
+
+
+class ClienteSimulado:
+    # Substituto do TelegramClient com os métodos usados por main.py. Cada download (ou cada iter_download)
+    # é uma conexão: toda requisição custa um RTT mais o tempo de transferir o bloco na banda da conexão.
+    # Como o TelegramClient, dorme sozinho em FloodWaits de até flood_sleep_threshold segundos e só levanta
+    # FloodWaitError acima disso.
+    def __init__(self, args, flood_sleep_threshold):
+        self.args = args
+        self.flood_sleep_threshold = flood_sleep_threshold
+        self.aleatorio = random.Random(args.seed)
+        self.banda = args.bandwidth_mbps * 1024 * 1024 / 8
+        self.rtt = args.rtt_ms / 1000
+        self.inicio = None
+        self.primeiro_byte = None
+        self.ttfb = []
+        self.requisicoes = 0
+        self.flood_waits = 0
+        self.flood_waits_absorvidos = 0
+        self.bytes_recebidos = 0
+        self.mensagens = self._gerar_historico()
+        self.por_id = {m.id: m for m in self.mensagens}
+        self.tamanhos = {m.media.id: m.file.size for m in self.mensagens if m.media}
+
+    def _gerar_historico(self):
+        args = self.args
+        pesos = dict(item.split("=") for item in args.mix.split(","))
+        tipos = list(pesos)
+        pesos = [float(pesos[t]) for t in tipos]
+        # Uma mensagem por hora a partir de 2024-01-01, para que --since/--until tenham o que cortar
+        inicio = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        mensagens = []
+        vistos = []
+        for message_id in range(args.messages, 0, -1):
+            data = inicio + datetime.timedelta(hours=message_id)
+            if self.aleatorio.random() >= args.media_ratio:
+                mensagens.append(MensagemSimulada(self, message_id, data))
+                continue
+            if vistos and self.aleatorio.random() < args.duplicate_ratio:
+                # Repostagem: mesma mídia em outra mensagem
+                tipo, media_id, size = self.aleatorio.choice(vistos)
+            else:
+                tipo = self.aleatorio.choices(tipos, pesos)[0]
+                media_id = message_id * 10
+                size = max(1, int(self.aleatorio.lognormvariate(math.log(args.size_median_kb * 1024),
+                                                                 args.size_sigma)))
+                vistos.append((tipo, media_id, size))
+            mensagens.append(MensagemSimulada(self, message_id, data, tipo, media_id, size))
+        return mensagens
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def _requisicao(self, tamanho=0):
+        while True:
+            self.requisicoes += 1
+            if self.aleatorio.random() >= self.args.flood_rate:
+                break
+            self.flood_waits += 1
+            if self.args.flood_seconds > self.flood_sleep_threshold:
+                raise FloodWaitError(request=None, capture=self.args.flood_seconds)
+            # Abaixo do limite o Telethon espera e repete a requisição sem que quem chamou perceba
+            self.flood_waits_absorvidos += 1
+            await asyncio.sleep(self.args.flood_seconds)
+        await asyncio.sleep(self.rtt + tamanho / self.banda)
+        self.bytes_recebidos += tamanho
+
+    async def get_messages(self, entity, limit=100, offset_id=0, min_id=0, max_id=0, ids=None, filter=None,
+                           offset_date=None):
+        # Sem **kwargs: um parâmetro que o simulador não implementa falha em vez de ser ignorado
+        await self._requisicao()
+        if ids is not None:
+            if isinstance(ids, int):
+                return self.por_id.get(ids)
+            return [self.por_id.get(i) for i in ids]
+        tipos = TIPOS_POR_FILTRO[type(filter)] if filter is not None else None
+        resultado = []
+        for message in self.mensagens:
+            if offset_id and message.id >= offset_id:
+                continue
+            if message.id <= min_id or (max_id and message.id >= max_id):
+                continue
+            if offset_date is not None and message.date >= offset_date:
+                continue
+            if tipos is not None and message.tipo not in tipos:
+                continue
+            resultado.append(message)
+            if len(resultado) >= limit:
+                break
+        return resultado
+
+    def _conteudo(self, media):
+        # Conteúdo determinístico derivado do id completo da mídia: duplicados têm o mesmo hash
+        # e mídias distintas nunca colidem na deduplicação por conteúdo
+        return random.Random(media.id).randbytes(TAMANHO_BLOCO)
+
+    def _registrar_primeiro_byte(self, inicio):
+        agora = time.monotonic()
+        self.ttfb.append(agora - inicio)
+        if self.primeiro_byte is None:
+            self.primeiro_byte = agora - self.inicio
+
+    async def iter_download(self, media, offset=0, request_size=TAMANHO_BLOCO, limit=None, file_size=None,
+                            **kwargs):
+        tamanho = file_size or self.tamanhos.get(media.id, 0)
+        bloco = self._conteudo(media)
+        inicio = time.monotonic()
+        partes = 0
+        while offset < tamanho and (limit is None or partes < limit):
+            parte = min(request_size, tamanho - offset)
+            await self._requisicao(parte)
+            if partes == 0:
+                self._registrar_primeiro_byte(inicio)
+            yield (bloco * (parte // len(bloco) + 1))[:parte]
+            offset += parte
+            partes += 1
+
+    async def download_media(self, message, file, progress_callback=None):
+        tamanho = message.file.size
+        bloco = self._conteudo(message.media)
+        inicio = time.monotonic()
+        baixados = 0
+        while baixados < tamanho:
+            parte = min(TAMANHO_BLOCO, tamanho - baixados)
+            await self._requisicao(parte)
+            if baixados == 0:
+                self._registrar_primeiro_byte(inicio)
+            resultado = file.write(bloco[:parte])
+            if asyncio.iscoroutine(resultado):
+                await resultado
+            baixados += parte
+            if progress_callback:
+                progress_callback(baixados, tamanho)
+        return file
+
+
+async def monitorar_event_loop(atrasos, intervalo=0.01):
+    # Atraso do event loop: quanto cada sleep curto demora além do pedido
+    while True:
+        inicio = time.monotonic()
+        await asyncio.sleep(intervalo)
+        atrasos.append(time.monotonic() - inicio - intervalo)
+
+
+def percentil(valores, p):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))]
+
+
+async def executar(main, args):
+    threshold = main.flood_sleep_threshold if args.flood_sleep_threshold is None else args.flood_sleep_threshold
+    client = ClienteSimulado(args, threshold)
+    selecao = main.interpretar_selecao(args)
+    channel = Channel(id=1, title="benchmark", photo=ChatPhotoEmpty(), date=None, access_hash=1)
+    controlador = main.ControladorConcorrencia(limite_inicial=args.batch_size, limite_maximo=args.max_concurrency)
+    atrasos = []
+    monitor = asyncio.create_task(monitorar_event_loop(atrasos))
+    client.inicio = inicio = time.monotonic()
+    try:
+        arquivamento = await main.baixar_todas_midias(client, channel, controlador=controlador, selecao=selecao)
+    finally:
+        monitor.cancel()
+    duracao = time.monotonic() - inicio
+
+    # Toda mídia selecionada do histórico simulado precisa ter chegado ao manifesto (varredura sem buracos),
+    # e nenhuma fora da seleção (filtros de tipo e data aplicados de fato)
+    with contextlib.closing(main.abrir_manifesto()) as manifesto:
+        registradas = {
+            row[0] for row in manifesto.conexao.execute("SELECT message_id FROM midias WHERE channel_id = ?",
+                                                        (channel.id,))
+        }
+    esperadas = {message.id for message in client.mensagens if message.media and selecao.aceita(message)}
+    faltando = sorted(esperadas - registradas, reverse=True)
+    fora_da_selecao = registradas - esperadas
+
+    resumo = controlador.resumo()
+    concluidos = arquivamento.resultados[main.ManifestoArquivo.CONCLUIDO]
+    return {
+        "mensagens": args.messages,
+        "midias": arquivamento.encontradas,
+        "resultados": dict(arquivamento.resultados),
+        "duracao_s": round(duracao, 3),
+        "arquivos_por_s": round(concluidos / duracao, 2),
+        "mb_por_s": round(arquivamento.bytes_baixados / duracao / 1024 / 1024, 3),
+        "ttfb_primeiro_s": round(client.primeiro_byte, 4) if client.primeiro_byte is not None else None,
+        "ttfb_mediana_s": round(statistics.median(client.ttfb), 4) if client.ttfb else None,
+        "lag_loop_medio_ms": round(statistics.mean(atrasos) * 1000, 2) if atrasos else None,
+        "lag_loop_p99_ms": round(percentil(atrasos, 0.99) * 1000, 2) if atrasos else None,
+        "lag_loop_max_ms": round(max(atrasos) * 1000, 2) if atrasos else None,
+        # ru_maxrss vem em KiB no Linux
+        "rss_pico_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) if resource else None,
+        "requisicoes": client.requisicoes,
+        "bytes_recebidos": client.bytes_recebidos,
+        "flood_waits": client.flood_waits,
+        "flood_waits_absorvidos": client.flood_waits_absorvidos,
+        "concorrencia_final": resumo["limite"],
+        "midias_faltando": len(faltando),
+        "ids_faltando": faltando[:20],
+        "midias_fora_da_selecao": len(fora_da_selecao),
+    }
+
+
+def criar_parser():
+    parser = argparse.ArgumentParser(description="Benchmark offline do Telegram Archiver com um cliente simulado.")
+    parser.add_argument("--messages", type=int, default=500, help="mensagens no histórico (padrão 500)")
+    parser.add_argument("--media-ratio", type=float, default=0.6, help="fração das mensagens com mídia")
+    parser.add_argument("--mix", default="photos=0.5,videos=0.2,documents=0.3",
+                        help="proporção de cada tipo de mídia (photos, videos, documents)")
+    parser.add_argument("--size-median-kb", type=float, default=256, help="mediana do tamanho das mídias (KiB)")
+    parser.add_argument("--size-sigma", type=float, default=1.0, help="dispersão log-normal dos tamanhos")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.05, help="fração de mídias repostadas")
+    parser.add_argument("--bandwidth-mbps", type=float, default=8, help="banda por conexão em Mbit/s")
+    parser.add_argument("--rtt-ms", type=float, default=60, help="latência de ida e volta por requisição")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="probabilidade de FloodWait por requisição")
+    parser.add_argument("--flood-seconds", type=int, default=1, help="duração de cada FloodWait injetado")
+    parser.add_argument("--flood-sleep-threshold", type=int,
+                        help="FloodWaits até este valor são esperados dentro do cliente, como no Telethon "
+                             "(padrão: o flood_sleep_threshold de main.py)")
+    parser.add_argument("--types", help="tipos de mídia, como em main.py (photos, videos, documents, audio)")
+    parser.add_argument("--min-size", type=float, metavar="MB", help="ignora mídias menores que MB")
+    parser.add_argument("--max-size", type=float, metavar="MB", help="ignora mídias maiores que MB")
+    parser.add_argument("--since", metavar="AAAA-MM-DD", help="somente mídias postadas a partir desta data")
+    parser.add_argument("--until", metavar="AAAA-MM-DD", help="somente mídias postadas até esta data (inclusive)")
+    parser.add_argument("--batch-size", type=int, default=5, help="downloads simultâneos iniciais (BATCH_SIZE)")
+    parser.add_argument("--max-concurrency", type=int, default=20, help="limite do controlador (MAX_CONCURRENCY)")
+    parser.add_argument("--large-threshold-mb", type=float, default=64, help="LARGE_FILE_THRESHOLD_MB")
+    parser.add_argument("--large-connections", type=int, default=4, help="LARGE_FILE_CONNECTIONS")
+    parser.add_argument("--seed", type=int, default=1, help="semente do histórico e das falhas")
+    parser.add_argument("--dir", help="pasta de downloads (padrão: temporária, apagada no fim)")
+    parser.add_argument("--json", action="store_true", help="imprime o resultado como JSON")
+    parser.add_argument("--verificar", action="store_true",
+                        help="sai com erro se alguma mídia do histórico não chegou ao manifesto")
+    return parser
+
+
+def main_benchmark():
+    args = criar_parser().parse_args()
+    pasta = args.dir or tempfile.mkdtemp(prefix="telegram_archiver_bench_")
+    os.makedirs(pasta, exist_ok=True)
+
+    # main.py lê a configuração ao ser importado
+    os.environ.setdefault("API_ID", "0")
+    os.environ.setdefault("API_HASH", "benchmark")
+    os.environ["DOWNLOAD_PATH"] = pasta
+    os.environ["HEADLESS"] = "1"
+    os.environ["PROGRESS_INTERVAL"] = "3600"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    main.large_file_threshold = int(args.large_threshold_mb * 1024 * 1024)
+    main.large_file_connections = args.large_connections
+    try:
+        resultado = asyncio.run(executar(main, args))
+    finally:
+        if not args.dir:
+            shutil.rmtree(pasta, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(resultado, ensure_ascii=False, indent=2))
+    else:
+        for chave, valor in resultado.items():
+            print(f"{chave:>20}: {valor}")
+    if args.verificar and resultado["midias_faltando"]:
+        sys.exit(f"ERRO: {resultado['midias_faltando']} mídias não chegaram ao manifesto: {resultado['ids_faltando']}")
+    if args.verificar and resultado["midias_fora_da_selecao"]:
+        sys.exit(f"ERRO: {resultado['midias_fora_da_selecao']} mídias fora da seleção chegaram ao manifesto")
+
+
+if __name__ == "__main__":
+    main_benchmark()
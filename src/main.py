@@ -16,26 +16,46 @@
  * along with Telegram Archiver downloader. If not, see <https://www.gnu.org/licenses/>.
  
 """
+import argparse
 import asyncio
+import contextlib
+import datetime
+import functools
 import os
+import re
 import hashlib
+import json
 import logging
+import socket
+import sqlite3
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from colorama import Fore, Style
 from tqdm.asyncio import tqdm
-from telethon import TelegramClient
+from telethon import TelegramClient, events, utils
 from telethon.tl.types import (
     DocumentAttributeFilename,
     InputMessagesFilterVideo,
     InputMessagesFilterPhotos,
+    InputMessagesFilterPhotoVideo,
     InputMessagesFilterDocument,
+    InputMessagesFilterMusic,
+    InputMessagesFilterVoice,
     Channel,
     Chat,
+    ChatPhotoEmpty,
+    PeerChannel,
+    PeerChat,
+    PeerUser,
+    User,
 )
 from telethon.tl.functions.messages import GetDialogsRequest
 from telethon.tl.types import InputPeerEmpty
-from telethon.tl.functions.users import GetFullUserRequest
-from telethon.errors import FloodWaitError
+from telethon.tl.types.messages import DialogsSlice
+from telethon.errors import FloodWaitError, FileReferenceExpiredError
 
 # Carregar variáveis de ambiente
 load_dotenv()
@@ -44,66 +64,800 @@ load_dotenv()
 api_id = int(os.getenv("API_ID"))
 api_hash = os.getenv("API_HASH")
 session_name = os.getenv("SESSION_NAME", "default_session")
-batch_size = int(os.getenv("BATCH_SIZE", 5))
-download_path_base = r"C:\Users\lucas\Desktop\zy\Telegram\Downloads"
+batch_size = int(os.getenv("BATCH_SIZE", 5))  # downloads simultâneos no início; o controlador ajusta depois
+max_concurrency = int(os.getenv("MAX_CONCURRENCY", batch_size * 4))
+# O Telethon dorme sozinho em FloodWaits de até 60 s (padrão), dentro da vaga do download e sem avisar ninguém.
+# Com 0 todo FloodWaitError chega ao ControladorConcorrencia, que pausa, reduz o limite e reagenda só a requisição
+flood_sleep_threshold = 0
+scan_concurrency = int(os.getenv("SCAN_CONCURRENCY", 4))  # chamadas de listagem do histórico simultâneas
+# Históricos longos são divididos em faixas de ids varridas em paralelo
+scan_segments = int(os.getenv("SCAN_SEGMENTS", scan_concurrency))
+scan_segment_min_ids = 1000  # só divide se cada faixa tiver ao menos este número de ids
+scan_segment_buffer = 10  # páginas com mídia que uma faixa pode adiantar antes de ser consumida
+entity_cache_ttl = int(os.getenv("ENTITY_CACHE_TTL", 24 * 3600))  # segundos
 
-semaphore = asyncio.Semaphore(20)
+# Várias contas: "sessao" ou "sessao:api_id:api_hash", separadas por vírgula (padrão: só SESSION_NAME)
+sessions = os.getenv("SESSIONS", "")
+# Processos que dividem o mesmo manifesto reservam canais por arrendamentos com validade de lease_ttl segundos
+worker_id = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+lease_ttl = int(os.getenv("LEASE_TTL", 120))
+
+# Arquivos a partir deste tamanho são baixados em partes paralelas, com retomada no meio do arquivo
+large_file_threshold = int(os.getenv("LARGE_FILE_THRESHOLD_MB", 64)) * 1024 * 1024
+large_file_connections = int(os.getenv("LARGE_FILE_CONNECTIONS", 4))
+large_file_part_size = 512 * 1024  # máximo aceito por upload.getFile, múltiplo de 4 KiB
+large_file_segment_parts = 8  # partes pedidas por vez por conexão, em ordem crescente no arquivo
+download_path_base = os.getenv("DOWNLOAD_PATH", r"C:\Users\lucas\Desktop\zy\Telegram\Downloads")
+manifest_file_name = "manifesto.sqlite3"
+# O manifesto (SQLite em modo WAL) é consultado no event loop: num download_path_base em NFS, aponte para um
+# disco local
+manifest_path = os.getenv("MANIFEST_PATH")
+partial_hash_size = 64 * 1024  # bytes iniciais usados no hash parcial de deduplicação
+# Disco: threads dedicadas ao sistema de arquivos, tamanho dos lotes de escrita e fsync antes do rename final
+disk_threads = int(os.getenv("DISK_THREADS", 4))
+disk_buffer_size = int(os.getenv("DISK_BUFFER_KB", 1024)) * 1024
+fsync_arquivos = os.getenv("FSYNC", "1").lower() not in ("0", "false", "nao", "não")
+# "pastas": um arquivo por mensagem na pasta do canal; "cas": conteúdo guardado uma vez por SHA-256 em
+# .blobs/ab/cd/<hash> e pastas dos canais com links (hardlink ou symlink) de nomes estáveis
+storage_layout = os.getenv("STORAGE_LAYOUT", "pastas").lower()
+cas_link = os.getenv("CAS_LINK", "hardlink").lower()
+cas_dir_name = ".blobs"
+
+# Sem terminal (cron, containers): nada de barras nem cores, só linhas JSON e resumos periódicos
+headless = os.getenv("HEADLESS", "").lower() in ("1", "true", "sim")
+progress_interval = float(os.getenv("PROGRESS_INTERVAL", 30))  # segundos entre resumos no modo headless
+progress_refresh = 0.25  # amostragem dos contadores de progresso (4 Hz)
+# Observabilidade: endpoint /metrics (Prometheus) e log de eventos em JSON lines, ambos desligados por padrão
+metrics_port = int(os.getenv("METRICS_PORT", 0))
+metrics_host = os.getenv("METRICS_HOST", "127.0.0.1")
+event_log = os.getenv("EVENT_LOG")
 
-# Configurar logging
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
-)
 logger = logging.getLogger(__name__)
 
 
-async def listar_canais_disponiveis(client):
-    logger.info("Buscando canais e grupos disponíveis...")
-    print(f"{Fore.YELLOW}Buscando canais e grupos disponíveis...{Style.RESET_ALL}")
+class HandlerTerminal(logging.Handler):
+    # Modo interativo: cada evento vira uma linha colorida, escrita acima da barra de progresso
+    CORES = {logging.ERROR: Fore.RED, logging.WARNING: Fore.YELLOW}
 
-    last_date = None
-    chunk_size = 200
-    all_dialogs = []
+    def emit(self, record):
+        try:
+            cor = getattr(record, "cor", None) or self.CORES.get(record.levelno)
+            linha = self.format(record)
+            tqdm.write(f"{cor}{linha}{Style.RESET_ALL}" if cor else linha)
+        except Exception:
+            self.handleError(record)
+
+
+class FormatadorJson(logging.Formatter):
+    # Modo headless: um objeto JSON por linha, com os campos extras do evento (ex.: resumo de progresso)
+    def format(self, record):
+        dados = {
+            "ts": round(record.created, 3),
+            "nivel": record.levelname,
+            "mensagem": record.getMessage(),
+        }
+        dados.update(getattr(record, "dados", None) or {})
+        return json.dumps(dados, ensure_ascii=False)
+
+
+class FiltroHeadless(logging.Filter):
+    # Eventos de cada arquivo ficam de fora; sobram avisos, erros e os resumos periódicos
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or not getattr(record, "por_arquivo", False)
+
+
+def configurar_saida(modo_headless=None):
+    global headless
+    if modo_headless is not None:
+        headless = modo_headless
+    if headless:
+        handler = logging.StreamHandler()
+        handler.setFormatter(FormatadorJson())
+        handler.addFilter(FiltroHeadless())
+    else:
+        handler = HandlerTerminal()
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    handler.setLevel(logging.INFO)
+    handlers = [handler]
+    if event_log:
+        # O log de eventos recebe tudo, inclusive os registros DEBUG de cada arquivo com as durações por fase
+        arquivo = logging.FileHandler(event_log, encoding="utf-8")
+        arquivo.setFormatter(FormatadorJson())
+        arquivo.setLevel(logging.DEBUG)
+        handlers.append(arquivo)
+    logging.basicConfig(level=logging.INFO, handlers=handlers, force=True)
+    logger.setLevel(logging.DEBUG)
+
+
+def evento(mensagem, cor=None, nivel=logging.INFO, por_arquivo=False, dados=None):
+    # Única saída de mensagens de status: o handler configurado decide entre terminal colorido e JSON
+    logger.log(nivel, mensagem, extra={"cor": cor, "por_arquivo": por_arquivo, "dados": dados})
+
+
+configurar_saida()
+
+
+# nome -> (tipo, descrição); todos exportados com o prefixo telegram_archiver_
+DESCRICOES_METRICAS = {
+    "bytes_baixados_total": ("counter", "Bytes recebidos do Telegram"),
+    "arquivos_total": ("counter", "Arquivos processados por status"),
+    "arquivo_duracao_segundos": ("histogram", "Duração de cada arquivo, da fila ao resultado"),
+    "fase_duracao_segundos": ("histogram", "Tempo de cada arquivo por fase (espera, dedup, transferencia, disco)"),
+    "flood_waits_total": ("counter", "FloodWaits recebidos por origem"),
+    "flood_wait_segundos_total": ("counter", "Segundos de FloodWait por origem"),
+    "paginas_historico_total": ("counter", "Páginas de histórico obtidas"),
+    "requisicao_historico_segundos": ("histogram", "Latência das chamadas de listagem do histórico"),
+    "fila_downloads": ("gauge", "Arquivos encontrados aguardando download"),
+    "downloads_em_andamento": ("gauge", "Downloads em andamento"),
+    "concorrencia_limite": ("gauge", "Limite atual de downloads simultâneos"),
+}
+
+
+class Metricas:
+    # Contadores, medidores e histogramas em memória, exportados no formato texto do Prometheus
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+    def __init__(self):
+        self.contadores = Counter()
+        self.medidores = {}
+        self.histogramas = {}
+
+    def incrementar(self, nome, valor=1, **labels):
+        self.contadores[nome, tuple(sorted(labels.items()))] += valor
+
+    def definir(self, nome, valor, **labels):
+        self.medidores[nome, tuple(sorted(labels.items()))] = valor
+
+    def observar(self, nome, valor, **labels):
+        chave = (nome, tuple(sorted(labels.items())))
+        histograma = self.histogramas.get(chave)
+        if histograma is None:
+            histograma = self.histogramas[chave] = [[0] * len(self.BUCKETS), 0.0, 0]
+        for i, limite in enumerate(self.BUCKETS):
+            if valor <= limite:
+                histograma[0][i] += 1
+        histograma[1] += valor
+        histograma[2] += 1
+
+    def valor(self, nome, **labels):
+        chave = (nome, tuple(sorted(labels.items())))
+        return self.contadores.get(chave, self.medidores.get(chave, 0))
+
+    def exportar(self):
+        def rotulos(labels, extra=()):
+            pares = []
+            for k, v in list(labels) + list(extra):
+                v = str(v).replace("\\", "\\\\").replace('"', '\\"')
+                pares.append(f'{k}="{v}"')
+            return "{" + ",".join(pares) + "}" if pares else ""
+
+        linhas = []
+        for nome, (tipo, descricao) in DESCRICOES_METRICAS.items():
+            completo = f"telegram_archiver_{nome}"
+            linhas.append(f"# HELP {completo} {descricao}")
+            linhas.append(f"# TYPE {completo} {tipo}")
+            if tipo == "histogram":
+                for (chave, labels), (buckets, soma, total) in sorted(self.histogramas.items()):
+                    if chave != nome:
+                        continue
+                    for limite, quantidade in zip(self.BUCKETS, buckets):
+                        linhas.append(f"{completo}_bucket{rotulos(labels, [('le', limite)])} {quantidade}")
+                    linhas.append(f"{completo}_bucket{rotulos(labels, [('le', '+Inf')])} {total}")
+                    linhas.append(f"{completo}_sum{rotulos(labels)} {soma}")
+                    linhas.append(f"{completo}_count{rotulos(labels)} {total}")
+            else:
+                origem = self.contadores if tipo == "counter" else self.medidores
+                for (chave, labels), valor in sorted(origem.items()):
+                    if chave == nome:
+                        linhas.append(f"{completo}{rotulos(labels)} {valor}")
+        return "\n".join(linhas) + "\n"
+
+
+metricas = Metricas()
+
+
+@contextlib.contextmanager
+def cronometrar(fases, fase):
+    # Soma a duração do bloco em fases[fase]
+    inicio = time.monotonic()
+    try:
+        yield
+    finally:
+        fases[fase] += time.monotonic() - inicio
+
+
+@contextlib.asynccontextmanager
+async def servidor_metricas():
+    # GET /metrics num servidor HTTP mínimo, só quando METRICS_PORT estiver definido
+    if not metrics_port:
+        yield
+        return
+
+    async def atender(reader, writer):
+        try:
+            requisicao = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if len(requisicao) >= 2 and requisicao[0] == "GET" and requisicao[1].split("?")[0] == "/metrics":
+                status, tipo = "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+                corpo = metricas.exportar().encode("utf-8")
+            else:
+                status, tipo, corpo = "404 Not Found", "text/plain", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {tipo}\r\nContent-Length: {len(corpo)}\r\n"
+                f"Connection: close\r\n\r\n".encode("latin-1") + corpo
+            )
+            await writer.drain()
+        except (ConnectionError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+
+    servidor = await asyncio.start_server(atender, metrics_host, metrics_port)
+    evento(f"Métricas disponíveis em http://{metrics_host}:{metrics_port}/metrics")
+    try:
+        yield
+    finally:
+        servidor.close()
+        await servidor.wait_closed()
+
+
+# Manifesto persistente do arquivo: cada migração é aplicada uma única vez (PRAGMA user_version)
+MIGRACOES_MANIFESTO = [
+    """
+    CREATE TABLE midias (
+        channel_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        document_id INTEGER,
+        access_hash INTEGER,
+        size INTEGER,
+        sha256 TEXT,
+        path TEXT,
+        status TEXT NOT NULL,
+        atualizado_em REAL NOT NULL,
+        PRIMARY KEY (channel_id, message_id)
+    );
+    CREATE INDEX idx_midias_document ON midias (document_id);
+    CREATE INDEX idx_midias_sha256 ON midias (sha256);
+    CREATE INDEX idx_midias_status ON midias (channel_id, status);
+    CREATE TABLE varreduras (
+        channel_id INTEGER PRIMARY KEY,
+        ultimo_id INTEGER NOT NULL DEFAULT 0,
+        scan_topo INTEGER,
+        scan_offset INTEGER
+    );
+    """,
+    """
+    ALTER TABLE midias ADD COLUMN mime_type TEXT;
+    ALTER TABLE midias ADD COLUMN hash_parcial TEXT;
+    CREATE INDEX idx_midias_tamanho ON midias (size, mime_type);
+    """,
+    """
+    CREATE TABLE entidades (
+        peer_id INTEGER PRIMARY KEY,
+        tipo TEXT NOT NULL,
+        access_hash INTEGER,
+        titulo TEXT,
+        sobrenome TEXT,
+        username TEXT,
+        ordem INTEGER,
+        atualizado_em REAL NOT NULL
+    );
+    CREATE INDEX idx_entidades_username ON entidades (username COLLATE NOCASE);
+    CREATE TABLE meta (
+        chave TEXT PRIMARY KEY,
+        valor
+    );
+    """,
+    """
+    CREATE TABLE varreduras_filtro (
+        channel_id INTEGER NOT NULL,
+        filtro TEXT NOT NULL,
+        ultimo_id INTEGER NOT NULL DEFAULT 0,
+        scan_topo INTEGER,
+        scan_offset INTEGER,
+        PRIMARY KEY (channel_id, filtro)
+    );
+    INSERT INTO varreduras_filtro (channel_id, filtro, ultimo_id, scan_topo, scan_offset)
+        SELECT channel_id, '', ultimo_id, scan_topo, scan_offset FROM varreduras;
+    DROP TABLE varreduras;
+    ALTER TABLE varreduras_filtro RENAME TO varreduras;
+    """,
+    """
+    CREATE TABLE arrendamentos (
+        recurso TEXT PRIMARY KEY,
+        dono TEXT NOT NULL,
+        expira_em REAL NOT NULL
+    );
+    """,
+]
+
+
+class ManifestoArquivo:
+    # Status de uma mídia no manifesto
+    PENDENTE = "pendente"
+    CONCLUIDO = "concluido"
+    DUPLICADO = "duplicado"
+    PULADO = "pulado"
+    FALHA = "falha"
+    INDISPONIVEL = "indisponivel"
+
+    def __init__(self, caminho):
+        os.makedirs(os.path.dirname(caminho) or ".", exist_ok=True)
+        self.caminho = caminho
+        # Vários processos podem usar o mesmo manifesto: espera o lock de escrita em vez de falhar. A espera
+        # acontece no event loop, então enquanto outro processo segura a escrita (até 30 s) nenhum download
+        # deste processo avança; depois disso a operação falha com sqlite3.OperationalError
+        self.conexao = sqlite3.connect(caminho, isolation_level=None, timeout=30)
+        self.conexao.execute("PRAGMA journal_mode=WAL")
+        self.conexao.execute("PRAGMA synchronous=NORMAL")
+        self._migrar()
+
+    def _migrar(self):
+        versao = self.conexao.execute("PRAGMA user_version").fetchone()[0]
+        for numero, script in enumerate(MIGRACOES_MANIFESTO[versao:], start=versao + 1):
+            self.conexao.executescript(f"BEGIN; {script} PRAGMA user_version = {numero}; COMMIT;")
+
+    def close(self):
+        self.conexao.close()
+
+    def status(self, channel_id, message_id):
+        row = self.conexao.execute(
+            "SELECT status FROM midias WHERE channel_id = ? AND message_id = ?", (channel_id, message_id)
+        ).fetchone()
+        return row[0] if row else None
+
+    def arquivo_registrado(self, channel_id, message_id):
+        # (path, sha256) deixado por um download concluído ou vinculado a um duplicado, ou None
+        row = self.conexao.execute(
+            "SELECT path, sha256 FROM midias WHERE channel_id = ? AND message_id = ? AND status IN (?, ?) "
+            "AND path IS NOT NULL",
+            (channel_id, message_id, self.CONCLUIDO, self.DUPLICADO),
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def possui_hash(self, sha256):
+        row = self.conexao.execute(
+            "SELECT path FROM midias WHERE sha256 = ? AND status = ? LIMIT 1", (sha256, self.CONCLUIDO)
+        ).fetchone()
+        return row[0] if row else None
+
+    def buscar_por_midia(self, media_id):
+        # Mídias encaminhadas/repostadas compartilham o mesmo document.id/photo.id, inclusive entre canais
+        # (path, sha256) de cada cópia concluída; quem chama confere no disco (fora do event loop) qual existe
+        return self.conexao.execute(
+            "SELECT path, sha256 FROM midias WHERE document_id = ? AND status = ? AND path IS NOT NULL",
+            (media_id, self.CONCLUIDO),
+        ).fetchall()
+
+    def candidatos_por_tamanho(self, size, mime_type):
+        return self.conexao.execute(
+            "SELECT path, hash_parcial, sha256 FROM midias WHERE size = ? AND mime_type IS ? AND status = ? "
+            "AND hash_parcial IS NOT NULL",
+            (size, mime_type, self.CONCLUIDO),
+        ).fetchall()
+
+    def registrar_pendentes(self, channel_id, messages):
+        agora = time.time()
+        rows = []
+        for message in messages:
+            media_id, access_hash = identificar_midia(message)
+            rows.append((channel_id, message.id, media_id, access_hash, tamanho_midia(message),
+                         message.file.mime_type if message.file else None, self.PENDENTE, agora))
+        self.conexao.executemany(
+            "INSERT OR IGNORE INTO midias "
+            "(channel_id, message_id, document_id, access_hash, size, mime_type, status, atualizado_em) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    def registrar_resultado(self, channel_id, message_id, status, sha256=None, path=None, hash_parcial=None):
+        self.conexao.execute(
+            "UPDATE midias SET status = ?, sha256 = COALESCE(?, sha256), path = COALESCE(?, path), "
+            "hash_parcial = COALESCE(?, hash_parcial), atualizado_em = ? "
+            "WHERE channel_id = ? AND message_id = ?",
+            (status, sha256, path, hash_parcial, time.time(), channel_id, message_id),
+        )
+
+    def pendentes(self, channel_id):
+        rows = self.conexao.execute(
+            "SELECT message_id FROM midias WHERE channel_id = ? AND status IN (?, ?) ORDER BY message_id DESC",
+            (channel_id, self.PENDENTE, self.FALHA),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def salvar_entidades(self, entidades, listagem=False):
+        # listagem=True grava a ordem dos diálogos e o horário, para servir a próxima listagem do cache
+        agora = time.time()
+        if listagem:
+            self.conexao.execute("UPDATE entidades SET ordem = NULL")
+        self.conexao.executemany(
+            "INSERT INTO entidades (peer_id, tipo, access_hash, titulo, sobrenome, username, ordem, atualizado_em) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (peer_id) DO UPDATE SET tipo = excluded.tipo, access_hash = excluded.access_hash, "
+            "titulo = excluded.titulo, sobrenome = excluded.sobrenome, username = excluded.username, "
+            "ordem = COALESCE(excluded.ordem, entidades.ordem), atualizado_em = excluded.atualizado_em",
+            [
+                (*entidade_para_linha(entity), i if listagem else None, agora)
+                for i, entity in enumerate(entidades)
+            ],
+        )
+        if listagem:
+            self.conexao.execute(
+                "INSERT OR REPLACE INTO meta (chave, valor) VALUES ('dialogos_listados_em', ?)", (agora,)
+            )
+
+    def entidades_listadas(self, ttl):
+        row = self.conexao.execute("SELECT valor FROM meta WHERE chave = 'dialogos_listados_em'").fetchone()
+        if not row or time.time() - row[0] > ttl:
+            return None
+        rows = self.conexao.execute(
+            "SELECT peer_id, tipo, access_hash, titulo, sobrenome, username FROM entidades "
+            "WHERE ordem IS NOT NULL ORDER BY ordem"
+        ).fetchall()
+        return [linha_para_entidade(row) for row in rows]
+
+    def buscar_entidade(self, referencia, ttl):
+        username, convite = utils.parse_username(str(referencia))
+        if isinstance(referencia, int):
+            # Aceita tanto o ID "cru" mostrado na listagem quanto o ID marcado (-100... ou -id de um grupo
+            # básico). O ID marcado identifica uma entidade só; um ID cru pode casar com várias, e aí vale o
+            # canal/grupo, depois o chat, depois o usuário
+            ids = [referencia] if referencia < 0 else [referencia, -referencia, -1000000000000 - referencia]
+            row = self.conexao.execute(
+                "SELECT peer_id, tipo, access_hash, titulo, sobrenome, username, atualizado_em FROM entidades "
+                f"WHERE peer_id IN ({', '.join('?' * len(ids))}) "
+                "ORDER BY tipo IN ('canal', 'grupo') DESC, tipo = 'chat' DESC",
+                ids,
+            ).fetchone()
+        elif username and not convite:
+            row = self.conexao.execute(
+                "SELECT peer_id, tipo, access_hash, titulo, sobrenome, username, atualizado_em FROM entidades "
+                "WHERE username = ? COLLATE NOCASE",
+                (username,),
+            ).fetchone()
+        else:
+            return None
+        if not row or time.time() - row[6] > ttl:
+            return None
+        return linha_para_entidade(row[:6])
+
+    # Cada filtro de busca tem sua própria varredura; filtro "" é o histórico completo
+    def estado_varredura(self, channel_id, filtro=""):
+        row = self.conexao.execute(
+            "SELECT ultimo_id, scan_topo, scan_offset FROM varreduras WHERE channel_id = ? AND filtro = ?",
+            (channel_id, filtro),
+        ).fetchone()
+        return row if row else (0, None, None)
+
+    def registrar_progresso_varredura(self, channel_id, scan_topo, scan_offset, filtro=""):
+        self.conexao.execute(
+            "INSERT INTO varreduras (channel_id, filtro, scan_topo, scan_offset) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (channel_id, filtro) DO UPDATE SET scan_topo = excluded.scan_topo, "
+            "scan_offset = excluded.scan_offset",
+            (channel_id, filtro, scan_topo, scan_offset),
+        )
+
+    def concluir_varredura(self, channel_id, ultimo_id, filtro=""):
+        self.conexao.execute(
+            "INSERT INTO varreduras (channel_id, filtro, ultimo_id) VALUES (?, ?, ?) "
+            "ON CONFLICT (channel_id, filtro) DO UPDATE SET ultimo_id = MAX(ultimo_id, excluded.ultimo_id), "
+            "scan_topo = NULL, scan_offset = NULL",
+            (channel_id, filtro, ultimo_id),
+        )
+
+    def arrendar(self, recurso, dono, ttl):
+        # Reserva (ou renova) o recurso para o dono; falha se outro processo tem um arrendamento ainda válido
+        agora = time.time()
+        cursor = self.conexao.execute(
+            "INSERT INTO arrendamentos (recurso, dono, expira_em) VALUES (?, ?, ?) "
+            "ON CONFLICT (recurso) DO UPDATE SET dono = excluded.dono, expira_em = excluded.expira_em "
+            "WHERE arrendamentos.dono = excluded.dono OR arrendamentos.expira_em < ?",
+            (recurso, dono, agora + ttl, agora),
+        )
+        return cursor.rowcount > 0
+
+    def liberar(self, recurso, dono):
+        self.conexao.execute("DELETE FROM arrendamentos WHERE recurso = ? AND dono = ?", (recurso, dono))
+
+
+def entidade_para_linha(entity):
+    if isinstance(entity, Channel):
+        tipo = "grupo" if entity.megagroup else "canal"
+        return utils.get_peer_id(entity), tipo, entity.access_hash, entity.title, None, entity.username
+    if isinstance(entity, User):
+        return (utils.get_peer_id(entity), "usuario", entity.access_hash, entity.first_name, entity.last_name,
+                entity.username)
+    return utils.get_peer_id(entity), "chat", None, getattr(entity, "title", None), None, None
+
+
+def linha_para_entidade(row):
+    # Reconstrói o objeto do Telethon a partir do cache; o access_hash basta para usá-lo nas requisições
+    peer_id, tipo, access_hash, titulo, sobrenome, username = row
+    real_id, _ = utils.resolve_id(peer_id)
+    if tipo in ("canal", "grupo"):
+        return Channel(id=real_id, title=titulo, photo=ChatPhotoEmpty(), date=None, access_hash=access_hash,
+                       username=username, megagroup=tipo == "grupo", broadcast=tipo == "canal")
+    if tipo == "usuario":
+        return User(id=real_id, access_hash=access_hash, first_name=titulo, last_name=sobrenome, username=username)
+    return Chat(id=real_id, title=titulo, photo=ChatPhotoEmpty(), participants_count=0, date=None, version=0)
+
+
+def abrir_manifesto():
+    return ManifestoArquivo(manifest_path or os.path.join(download_path_base, manifest_file_name))
+
+
+class ControladorConcorrencia:
+    # Limite de downloads simultâneos ajustado em AIMD: a cada janela, sobe 1 enquanto a vazão medida
+    # (bytes/s) continua crescendo, recua 1 se ela cai e corta pela metade quando chega um FloodWait.
+    # Durante o FloodWait nenhum download novo começa; os que estão em andamento seguem normalmente.
+    def __init__(self, limite_inicial=None, limite_minimo=1, limite_maximo=None, janela=5.0):
+        self.limite_maximo = limite_maximo or max_concurrency
+        self.limite_minimo = limite_minimo
+        self.limite = max(limite_minimo, min(limite_inicial or batch_size, self.limite_maximo))
+        self.janela = janela
+        self.em_andamento = 0
+        self.condicao = asyncio.Condition()
+        self.pausa_ate = 0.0
+        self.inicio = time.monotonic()
+        self.inicio_janela = self.inicio
+        self.bytes_janela = 0
+        self.bytes_total = 0
+        self.taxa_atual = 0.0
+        self.flood_waits = 0
+        self.tempo_flood_wait = 0.0
+        self.semaforo_varredura = asyncio.Semaphore(scan_concurrency)
+        self.pausa_varredura_ate = 0.0
+
+    async def __aenter__(self):
+        while True:
+            espera = self.pausa_ate - time.monotonic()
+            if espera > 0:
+                await asyncio.sleep(espera)
+                continue
+            async with self.condicao:
+                if self.em_andamento < self.limite and self.pausa_ate <= time.monotonic():
+                    self.em_andamento += 1
+                    return self
+                await self.condicao.wait()
+
+    async def __aexit__(self, *exc_info):
+        async with self.condicao:
+            self.em_andamento -= 1
+            self.condicao.notify_all()
+
+    def registrar_bytes(self, quantidade):
+        self.bytes_janela += quantidade
+        self.bytes_total += quantidade
+        agora = time.monotonic()
+        duracao = agora - self.inicio_janela
+        if duracao < self.janela:
+            return
+        if not self.bytes_janela and not self.em_andamento:
+            # Ocioso, sem downloads: não há vazão para medir
+            self.inicio_janela = agora
+            return
+        taxa = self.bytes_janela / duracao
+        limite_anterior = self.limite
+        # Só faz sentido subir se todos os slots estavam ocupados (senão a vazão não é limitada por eles)
+        if taxa > self.taxa_atual * 1.05 and self.em_andamento >= self.limite:
+            self.limite = min(self.limite_maximo, self.limite + 1)
+        elif taxa < self.taxa_atual * 0.8:
+            self.limite = max(self.limite_minimo, self.limite - 1)
+        self.taxa_atual = taxa
+        self.inicio_janela = agora
+        self.bytes_janela = 0
+        if self.limite != limite_anterior:
+            evento(f"Concorrência ajustada de {limite_anterior} para {self.limite} ({taxa / 1024 / 1024:.2f} MB/s)")
+            self._notificar()
 
+    def registrar_flood_wait(self, segundos):
+        self.flood_waits += 1
+        self.tempo_flood_wait += segundos
+        metricas.incrementar("flood_waits_total", origem="download")
+        metricas.incrementar("flood_wait_segundos_total", segundos, origem="download")
+        agora = time.monotonic()
+        em_pausa = self.pausa_ate > agora
+        self.pausa_ate = max(self.pausa_ate, agora + segundos)
+        if em_pausa:
+            # Os outros downloads em andamento recebem o mesmo FloodWait: o limite cai uma vez por pausa
+            self.inicio_janela = self.pausa_ate
+            return
+        limite_anterior = self.limite
+        self.limite = max(self.limite_minimo, self.limite // 2)
+        # A janela atual inclui a pausa; recomeça a medição depois dela
+        self.inicio_janela = self.pausa_ate
+        self.bytes_janela = 0
+        self.taxa_atual = 0.0
+        evento(f"Concorrência reduzida de {limite_anterior} para {self.limite} após FloodWait de {segundos}s")
+
+    def livre(self):
+        # Um download novo começaria agora: fora de FloodWait e com slot sobrando
+        return self.pausa_ate <= time.monotonic() and self.em_andamento < self.limite
+
+    @contextlib.asynccontextmanager
+    async def varredura(self):
+        # Limita as chamadas de listagem do histórico feitas ao mesmo tempo (todos os canais somados)
+        while (espera := self.pausa_varredura_ate - time.monotonic()) > 0:
+            await asyncio.sleep(espera)
+        async with self.semaforo_varredura:
+            yield
+
+    def registrar_flood_wait_varredura(self, segundos):
+        # O limite de listagem é separado do de download: pausa só as varreduras
+        self.flood_waits += 1
+        self.tempo_flood_wait += segundos
+        self.pausa_varredura_ate = max(self.pausa_varredura_ate, time.monotonic() + segundos)
+        metricas.incrementar("flood_waits_total", origem="varredura")
+        metricas.incrementar("flood_wait_segundos_total", segundos, origem="varredura")
+
+    def _notificar(self):
+        async def notificar():
+            async with self.condicao:
+                self.condicao.notify_all()
+
+        self._tarefa_notificacao = asyncio.get_running_loop().create_task(notificar())
+
+    def resumo(self):
+        duracao = max(time.monotonic() - self.inicio, 1e-9)
+        return {
+            "limite": self.limite,
+            "em_andamento": self.em_andamento,
+            "taxa_atual": self.taxa_atual,
+            "taxa_media": self.bytes_total / duracao,
+            "flood_waits": self.flood_waits,
+            "tempo_flood_wait": self.tempo_flood_wait,
+        }
+
+
+async def aguardando_flood_wait(chamada, *args, **kwargs):
+    # Requisições fora do controlador (resolver entidades, listar diálogos): espera o FloodWait e repete só esta
     while True:
         try:
-            result = await client(
-                GetDialogsRequest(
-                    offset_date=last_date,
-                    offset_id=0,
-                    offset_peer=InputPeerEmpty(),
-                    limit=chunk_size,
-                    hash=0,
-                )
+            return await chamada(*args, **kwargs)
+        except FloodWaitError as e:
+            evento(f"Flood wait: {e}. Aguardando {e.seconds} segundos.", nivel=logging.ERROR)
+            await asyncio.sleep(e.seconds)
+
+
+class ContaTelegram:
+    # Uma sessão do Telegram com seu próprio controlador: FloodWait e vazão são medidos por conta
+    def __init__(self, nome, client, controlador=None):
+        self.nome = nome
+        self.client = client
+        self.controlador = controlador or ControladorConcorrencia()
+        self.entidades = {}  # peer_id -> entidade vista por esta conta (None se ela não tem acesso)
+        self.canais = 0
+
+    async def entidade(self, channel):
+        # O access_hash de canais e usuários é diferente em cada conta: cada uma resolve a sua
+        peer_id = utils.get_peer_id(channel)
+        if peer_id not in self.entidades:
+            entity = None
+            for referencia in (peer_id, getattr(channel, "username", None)):
+                if referencia is None:
+                    continue
+                try:
+                    entity = await aguardando_flood_wait(self.client.get_entity, referencia)
+                    break
+                except Exception:
+                    continue
+            self.entidades[peer_id] = entity
+        return self.entidades[peer_id]
+
+    async def recarregar(self, channel, message):
+        # A mesma mensagem buscada por esta conta, com file_reference válido para ela
+        entity = await self.entidade(channel)
+        if entity is None:
+            return None
+        recarregada = await obter_mensagens(self.client, entity, self.controlador, ids=message.id)
+        return recarregada if possui_arquivo(recarregada) else None
+
+
+def interpretar_sessoes(texto):
+    contas = []
+    for item in texto.split(","):
+        nome, _, credenciais = item.strip().partition(":")
+        if not nome:
+            continue
+        if credenciais:
+            id_conta, _, hash_conta = credenciais.partition(":")
+            if not id_conta.isdigit() or not hash_conta:
+                raise ValueError(f"Sessão inválida: {item.strip()} (use SESSAO ou SESSAO:API_ID:API_HASH)")
+            contas.append((nome, int(id_conta), hash_conta))
+        else:
+            contas.append((nome, api_id, api_hash))
+    return contas or [(session_name, api_id, api_hash)]
+
+
+async def distribuir_canal(contas, channel):
+    # O canal fica com a conta com acesso a ele que tem menos canais até agora; ela faz a varredura
+    for conta in sorted(contas, key=lambda c: c.canais):
+        if await conta.entidade(channel) is not None:
+            conta.canais += 1
+            return conta
+    contas[0].canais += 1
+    return contas[0]
+
+
+async def buscar_dialogos(client):
+    # Os diálogos já vêm com users/chats na mesma resposta: cada diálogo é ligado ao seu peer,
+    # sem nenhuma requisição extra por usuário
+    chunk_size = 100
+    offset_date, offset_id, offset_peer = None, 0, InputPeerEmpty()
+    vistos = set()
+    all_dialogs = []
+
+    while True:
+        result = await aguardando_flood_wait(
+            client,
+            GetDialogsRequest(
+                offset_date=offset_date,
+                offset_id=offset_id,
+                offset_peer=offset_peer,
+                limit=chunk_size,
+                hash=0,
             )
-            if not result.dialogs:
-                break
-
-            for dialog, entity in zip(result.dialogs, result.chats):
-                if isinstance(entity, (Channel, Chat)):
-                    all_dialogs.append(entity)
-                elif not isinstance(entity, InputPeerEmpty):
-                    # Se for um usuário, tenta obter informações detalhadas
-                    try:
-                        user_full = await client(GetFullUserRequest(entity.id))
-                        if user_full and user_full.user:
-                            all_dialogs.append(user_full.user)
-                    except Exception as e:
-                        logger.error(f"ERRO: Não foi possível buscar informações completas do usuário: {e}")
-                        print(
-                            f"{Fore.RED}ERRO: Não foi possível buscar informações completas do usuário: {e}{Style.RESET_ALL}"
-                        )
+        )
+        usuarios = {user.id: user for user in result.users}
+        chats = {chat.id: chat for chat in result.chats}
+        mensagens = {(utils.get_peer_id(m.peer_id), m.id): m for m in result.messages}
 
-            last_date = result.messages[-1].date if result.messages else None
+        cursor = None
+        for dialog in result.dialogs:
+            peer = dialog.peer
+            if isinstance(peer, PeerUser):
+                entity = usuarios.get(peer.user_id)
+            elif isinstance(peer, PeerChat):
+                entity = chats.get(peer.chat_id)
+            elif isinstance(peer, PeerChannel):
+                entity = chats.get(peer.channel_id)
+            else:
+                entity = None
+            if entity is None:
+                continue
+            peer_id = utils.get_peer_id(peer)
+            topo = mensagens.get((peer_id, dialog.top_message))
+            if topo is not None:
+                cursor = (topo.date, dialog.top_message, entity)
+            if peer_id not in vistos:
+                vistos.add(peer_id)
+                all_dialogs.append(entity)
 
-            if len(result.dialogs) < chunk_size:
-                break
+        if not isinstance(result, DialogsSlice) or len(result.dialogs) < chunk_size or cursor is None:
+            return all_dialogs
 
-        except Exception as e:
-            logger.error(f"ERRO: Falha ao buscar diálogos: {e}")
-            print(f"{Fore.RED}ERRO: Falha ao buscar diálogos: {e}{Style.RESET_ALL}")
-            return []
+        # Próxima página começa depois do último diálogo com peer e mensagem do topo conhecidos:
+        # data, id e peer saem do mesmo diálogo para o servidor não pular nem repetir páginas
+        offset_date, offset_id, entidade = cursor
+        offset_peer = utils.get_input_peer(entidade)
 
-    if all_dialogs:
+
+async def listar_canais_disponiveis(client, manifesto=None, atualizar=False):
+    manifesto_proprio = manifesto is None
+    if manifesto_proprio:
+        manifesto = abrir_manifesto()
+
+    try:
+        all_dialogs = None if atualizar else manifesto.entidades_listadas(entity_cache_ttl)
+        if all_dialogs is not None:
+            evento("Lista de canais e grupos carregada do cache local.")
+        else:
+            evento("Buscando canais e grupos disponíveis...")
+            try:
+                all_dialogs = await buscar_dialogos(client)
+            except Exception as e:
+                evento(f"ERRO: Falha ao buscar diálogos: {e}", nivel=logging.ERROR)
+                return []
+            manifesto.salvar_entidades(all_dialogs, listagem=True)
+    finally:
+        if manifesto_proprio:
+            manifesto.close()
+
+    if not all_dialogs:
+        evento("Nenhum canal, grupo ou usuário encontrado.", nivel=logging.ERROR)
+    elif not headless:
+        # A lista numerada é para escolha no terminal; no modo headless não há quem escolha
         print(f"{Fore.GREEN}Canais, grupos e usuários disponíveis:{Style.RESET_ALL}")
         for i, entity in enumerate(all_dialogs):
             if hasattr(entity, "title"):
@@ -116,322 +870,1820 @@ async def listar_canais_disponiveis(client):
                 )
             else:
                 print(f"{i + 1}. {Fore.BLUE}ID do Usuário: {entity.id}{Style.RESET_ALL}")
+    return all_dialogs
+
+
+def identificar_midia(message):
+    media = message.document or message.photo
+    if media is None:
+        return None, None
+    return media.id, media.access_hash
 
+
+def possui_arquivo(message):
+    # Só fotos e documentos são baixáveis; prévias de link sem arquivo, enquetes, localização e dados não
+    return message is not None and identificar_midia(message) != (None, None)
+
+
+def tamanho_midia(message):
+    if message.document:
+        return message.document.size
+    if message.file and message.file.size:
+        return message.file.size
+    return 0
+
+
+def nome_arquivo(message):
+    name = message.file.name if message.file else None
+    ext = (message.file.ext if message.file else None) or ""
+    if not name:
+        kind = "photo" if message.photo else "document"
+        name = f"{kind}_{message.date:%Y-%m-%d_%H-%M-%S}_{message.id}{ext}"
+    elif not os.path.splitext(name)[1]:
+        name += ext
+    # Remove caracteres inválidos em nomes de arquivo (Windows) e separadores de diretório
+    return re.sub(r'[<>:"/\\|?*\x00-\x1f]', "_", name).strip(" .") or f"{message.id}{ext}"
+
+
+def nome_estavel(message):
+    # "<id>_<data>_<nome original>": o mesmo nome em toda execução, sem depender de colisões
+    name = message.file.name if message.file else None
+    ext = (message.file.ext if message.file else None) or ""
+    prefixo = f"{message.id}_{message.date:%Y%m%d-%H%M%S}"
+    if name:
+        name = f"{prefixo}_{name}" if os.path.splitext(name)[1] else f"{prefixo}_{name}{ext}"
     else:
-        print(f"{Fore.RED}Nenhum canal, grupo ou usuário encontrado.{Style.RESET_ALL}")
-    return all_dialogs
+        name = f"{prefixo}{ext}"
+    stem, ext = os.path.splitext(re.sub(r'[<>:"/\\|?*\x00-\x1f]', "_", name).strip(" ."))
+    return stem[:150] + ext
+
+
+def caminho_blob(sha256):
+    return os.path.join(download_path_base, cas_dir_name, sha256[:2], sha256[2:4], sha256)
+
+
+def caminho_temporario_cas(channel, message):
+    # Estável por mensagem para que um download grande interrompido seja retomado
+    return os.path.join(download_path_base, cas_dir_name, "tmp", f"{channel.id}_{message.id}")
+
+
+def caminho_retomada(channel, message, folder_name):
+    # Base do ".part"/".part.map" de um download grande. O nome final na pasta do canal depende de qual
+    # mensagem reservou o nome primeiro e pode trocar entre execuções; o estado da retomada fica preso à
+    # mensagem para nunca juntar partes de arquivos diferentes
+    if storage_layout == "cas":
+        return caminho_temporario_cas(channel, message)
+    return os.path.join(download_path_base, folder_name, f".{channel.id}_{message.id}")
 
 
-async def calcular_hash_arquivo(file_path):
-    sha256_hash = hashlib.sha256()
+# Destinos de downloads em andamento: o arquivo final só aparece no fim, então o nome é reservado antes
+destinos_em_uso = set()
+
+# Mídias em download, por document.id/photo.id: um repost da mesma mídia espera o download em andamento
+# em vez de baixá-la de novo (o manifesto só conhece as mídias já concluídas)
+midias_em_andamento = {}
+
+
+async def reservar_midia(media_id):
+    # Retorna (path, sha256) do arquivo deixado por outro download da mesma mídia, ou None quando a mídia
+    # ficou reservada para quem chamou, que deve baixá-la e depois chamar liberar_midia
+    if media_id is None:
+        return None
+    while media_id in midias_em_andamento:
+        existente = await asyncio.shield(midias_em_andamento[media_id])
+        if existente:
+            return existente
+    midias_em_andamento[media_id] = asyncio.get_running_loop().create_future()
+    return None
+
+
+def liberar_midia(media_id, existente):
+    # Acorda quem espera a mesma mídia; com None (falha, FloodWait) o próximo da fila baixa ele mesmo
+    pronta = midias_em_andamento.pop(media_id, None)
+    if pronta is not None and not pronta.done():
+        pronta.set_result(existente)
+
+
+def caminho_destino(message, folder_name):
+    if storage_layout == "cas":
+        # Subpastas por mês mantêm os diretórios pequenos; o id da mensagem torna o nome único no canal
+        return os.path.join(download_path_base, folder_name, f"{message.date:%Y-%m}", nome_estavel(message))
+    destino = os.path.join(download_path_base, folder_name, nome_arquivo(message))
+    if os.path.exists(destino) or destino in destinos_em_uso:
+        # Outra mensagem já usa esse nome; o id da mensagem torna o caminho estável entre execuções
+        stem, ext = os.path.splitext(destino)
+        destino = f"{stem} ({message.id}){ext}"
+    return destino
+
+
+def vincular_duplicado(arquivo_original, destino):
+    # Hard link quando o sistema de arquivos permite; senão a mídia fica apenas referenciada no manifesto
     try:
-        with open(file_path, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
-    except Exception as e:
-        logger.error(f"ERRO: Falha ao calcular hash do arquivo {file_path}: {e}")
-        print(f"{Fore.RED}ERRO: Falha ao calcular hash do arquivo {file_path}: {e}{Style.RESET_ALL}")
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        if os.path.lexists(destino):
+            os.remove(destino)
+        os.link(arquivo_original, destino)
+        return destino
+    except OSError:
         return None
 
 
-async def baixar_arquivo(message, folder_name, global_progress_bar, channel, downloaded_hashes, file_index,
-                         total_files):
-    async with semaphore:
-        file_path = None
+def vincular_visao(blob, destino):
+    # Entrada da pasta do canal para um blob: hard link, ou symlink relativo se pedido ou se o hard link falhar
+    if cas_link != "symlink":
+        vinculo = vincular_duplicado(blob, destino)
+        if vinculo:
+            return vinculo
+    try:
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        if os.path.lexists(destino):
+            os.remove(destino)
+        os.symlink(os.path.relpath(blob, os.path.dirname(destino)), destino)
+        return destino
+    except OSError:
+        return None
+
+
+def vincular_existente(arquivo_original, sha256, destino):
+    # Duplicado detectado antes do download: no layout cas a entrada do canal aponta para o blob (respeitando
+    # CAS_LINK), não para a entrada de outro canal. Retorna (vínculo criado ou None, caminho de referência).
+    if storage_layout == "cas" and sha256:
+        blob = caminho_blob(sha256)
+        if os.path.isfile(blob):
+            return vincular_visao(blob, destino), blob
+    return vincular_duplicado(arquivo_original, destino), arquivo_original
+
+
+def guardar_blob(file_path, sha256, destino):
+    # Move o arquivo baixado para o armazenamento por conteúdo (ou o descarta, se o blob já existe)
+    blob = caminho_blob(sha256)
+    if os.path.exists(blob):
+        os.remove(file_path)
+    else:
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        os.replace(file_path, blob)
+    return vincular_visao(blob, destino) or blob
+
+
+async def calcular_hash_parcial_remoto(message):
+    async for chunk in message.client.iter_download(message.media, request_size=partial_hash_size, limit=1):
+        return hashlib.sha256(chunk[:partial_hash_size]).hexdigest()
+    return None
+
+
+def filtrar_existentes(rows):
+    # Linhas do manifesto cujo arquivo (primeira coluna) ainda existe no disco
+    return [row for row in rows if os.path.isfile(row[0])]
+
+
+async def buscar_duplicado(message, manifesto, file_size):
+    # Retorna (caminho, sha256) do arquivo já existente com o mesmo conteúdo, ou (None, None)
+    media_id, _ = identificar_midia(message)
+    if media_id is not None:
+        existentes = await em_disco(filtrar_existentes, manifesto.buscar_por_midia(media_id))
+        if existentes:
+            return existentes[0]
+
+    # Fallback para reenvios (mesmo conteúdo, outro id): tamanho + mime e depois hash dos primeiros bytes,
+    # baixando só o primeiro bloco e apenas quando existe algum candidato
+    if not file_size:
+        return None, None
+    candidatos = await em_disco(
+        filtrar_existentes,
+        manifesto.candidatos_por_tamanho(file_size, message.file.mime_type if message.file else None),
+    )
+    if not candidatos:
+        return None, None
+    hash_parcial = await calcular_hash_parcial_remoto(message)
+    return next(((path, sha256) for path, candidato, sha256 in candidatos if candidato == hash_parcial),
+                (None, None))
+
+
+# Todo acesso ao sistema de arquivos do caminho de download roda nestas threads: num disco lento (ex.: NFS)
+# as chamadas bloqueantes não seguram o event loop nem os downloads em andamento
+executor_disco = ThreadPoolExecutor(max_workers=disk_threads, thread_name_prefix="disco")
+
+
+async def em_disco(funcao, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(executor_disco, functools.partial(funcao, *args, **kwargs))
+
+
+def preallocar(arquivo, tamanho):
+    # Reserva o espaço de uma vez: menos fragmentação, e falta de espaço aparece antes do download
+    if tamanho <= 0:
+        return
+    if hasattr(os, "posix_fallocate"):
         try:
-            # Obter o tamanho do arquivo
-            file_size = 0
-            if message.video:
-                file_size = message.video.size
-            elif message.document:
-                file_size = message.document.size
+            os.posix_fallocate(arquivo.fileno(), 0, tamanho)
+            return
+        except OSError:
+            pass
+    arquivo.truncate(tamanho)
 
-            if file_size > 6 * 1024 * 1024 * 1024:
-                print(
-                    f"{Fore.YELLOW}AVISO: Arquivo {file_index}/{total_files} - {message.id} é maior que 6GB ({file_size} bytes), pulando download.{Style.RESET_ALL}")
-                logger.info(
-                    f"AVISO: Arquivo {file_index}/{total_files} - {message.id} é maior que 6GB, pulando download.")
-                return
-
-            # Extrair info do canal para logging
-            if hasattr(channel, "title"):
-                channel_info = f"Canal: {channel.title} (ID: {channel.id})"
-            elif hasattr(channel, "first_name"):
-                channel_info = f"Usuário: {channel.first_name} {channel.last_name} (ID: {channel.id})"
+
+def remover_se_existir(file_path):
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+
+class ConfirmacaoDisco:
+    # Torna visíveis os arquivos concluídos: fsync do ".part" e rename atômico para o nome final, então um
+    # arquivo com o nome final está sempre completo. Pedidos que chegam enquanto um lote é gravado entram
+    # juntos no lote seguinte (group commit): com muitos downloads terminando ao mesmo tempo o custo do
+    # fsync é dividido entre eles, sem esperar quando há poucos.
+    def __init__(self):
+        self.fila = []
+        self.tarefa = None
+
+    async def confirmar(self, part_path, file_path):
+        futuro = asyncio.get_running_loop().create_future()
+        self.fila.append((part_path, file_path, futuro))
+        if self.tarefa is None or self.tarefa.done():
+            self.tarefa = asyncio.create_task(self._executar())
+        await futuro
+        return file_path
+
+    async def _executar(self):
+        while self.fila:
+            lote, self.fila = self.fila, []
+            try:
+                erros = await em_disco(self._confirmar_lote, [(part, final) for part, final, _ in lote])
+            except Exception as e:
+                erros = [e] * len(lote)
+            for (_, _, futuro), erro in zip(lote, erros):
+                if futuro.done():
+                    continue
+                if erro:
+                    futuro.set_exception(erro)
+                else:
+                    futuro.set_result(None)
+
+    @staticmethod
+    def _confirmar_lote(lote):
+        erros = []
+        pastas = set()
+        for part_path, file_path in lote:
+            try:
+                if fsync_arquivos:
+                    fd = os.open(part_path, os.O_RDWR)  # no Windows o fsync exige o arquivo aberto para escrita
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                os.replace(part_path, file_path)
+                pastas.add(os.path.dirname(file_path))
+                erros.append(None)
+            except OSError as e:
+                erros.append(e)
+        if fsync_arquivos and hasattr(os, "O_DIRECTORY"):
+            # O rename só fica durável depois do fsync da pasta (uma vez por pasta no lote)
+            for pasta in pastas:
+                try:
+                    fd = os.open(pasta, os.O_RDONLY | os.O_DIRECTORY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                except OSError:
+                    pass
+        return erros
+
+
+confirmacao_disco = ConfirmacaoDisco()
+
+
+class ArquivoComHash:
+    # Destino de escrita para download_media. Os blocos ficam num buffer e são gravados em lotes de
+    # disk_buffer_size numa thread de disco, que também atualiza o SHA-256; há no máximo um lote gravando
+    # enquanto o próximo enche. O arquivo é um ".part" pré-alocado que só recebe o nome final em concluir().
+    def __init__(self, file_path, file_size=0):
+        self.file_path = file_path
+        self.part_path = f"{file_path}.part"
+        self.file_size = file_size
+        self.arquivo = None
+        self.sha256 = hashlib.sha256()
+        self.inicio = bytearray()
+        self.buffer = bytearray()
+        self.gravacao = None
+        self.posicao = 0
+
+    async def abrir(self):
+        self.arquivo = await em_disco(self._abrir)
+        return self
+
+    def _abrir(self):
+        arquivo = open(self.part_path, "wb")
+        preallocar(arquivo, self.file_size)
+        return arquivo
+
+    def _gravar(self, dados):
+        self.arquivo.write(dados)
+        self.sha256.update(dados)
+
+    async def _descarregar(self):
+        if self.gravacao is not None:
+            await self.gravacao
+            self.gravacao = None
+        if self.buffer:
+            dados, self.buffer = self.buffer, bytearray()
+            self.gravacao = asyncio.ensure_future(em_disco(self._gravar, dados))
+
+    async def write(self, chunk):
+        if len(self.inicio) < partial_hash_size:
+            self.inicio += chunk[:partial_hash_size - len(self.inicio)]
+        self.buffer += chunk
+        self.posicao += len(chunk)
+        if len(self.buffer) >= disk_buffer_size:
+            await self._descarregar()
+        return len(chunk)
+
+    def tell(self):
+        return self.posicao
+
+    def flush(self):
+        # Chamado pelo Telethon sem await; a gravação pendente é concluída em concluir()
+        pass
+
+    def _fechar(self):
+        # A pré-alocação pode ter deixado o arquivo maior que o recebido
+        self.arquivo.truncate(self.posicao)
+        self.arquivo.close()
+
+    async def concluir(self):
+        await self._descarregar()
+        await self._descarregar()
+        await em_disco(self._fechar)
+        return await confirmacao_disco.confirmar(self.part_path, self.file_path)
+
+    async def descartar(self):
+        if self.gravacao is not None:
+            with contextlib.suppress(Exception):
+                await self.gravacao
+        if self.arquivo is not None:
+            await em_disco(self.arquivo.close)
+        await em_disco(remover_se_existir, self.part_path)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    def hash_parcial(self):
+        return hashlib.sha256(self.inicio).hexdigest()
+
+
+class DownloadEmPartes:
+    # Download de arquivos grandes: o documento é dividido em partes alinhadas de large_file_part_size,
+    # buscadas por várias tarefas em paralelo e gravadas por posição num ".part" pré-alocado. O mapa de
+    # partes concluídas (".part.map") permite retomar o download no meio do arquivo após uma interrupção.
+    # As conexões pegam trechos curtos em ordem crescente, então as partes chegam quase em sequência e o
+    # SHA-256 do prefixo contíguo é atualizado na thread que grava, sem reler o arquivo no fim.
+    # O ".part" e o mapa ficam em retomada (ver caminho_retomada) e só no fim viram file_path.
+    def __init__(self, message, file_path, file_size, retomada):
+        self.message = message
+        self.documento = message.document
+        self.file_path = file_path
+        self.part_path = f"{retomada}.part"
+        self.map_path = f"{retomada}.part.map"
+        self.file_size = file_size
+        self.total_partes = (file_size + large_file_part_size - 1) // large_file_part_size
+        self.mapa = None
+        self.recebidos = 0  # bytes baixados nesta execução (sem as partes retomadas do disco)
+        self.alteracoes = 0
+        self.trava_mapa = asyncio.Lock()
+        self.sha256 = hashlib.sha256()
+        self.inicio = b""
+        self.gravadas = None  # partes já no disco, vistas pelas threads de gravação
+        self.proxima_hash = 0  # primeira parte fora do prefixo contíguo já incluído no hash
+        self.fora_de_ordem = {}
+        self.limite_fora_de_ordem = 2 * large_file_connections * large_file_segment_parts
+        self.trava_hash = threading.Lock()
+
+    def _tamanho_parte(self, indice):
+        return min(large_file_part_size, self.file_size - indice * large_file_part_size)
+
+    def _carregar_mapa(self):
+        if os.path.exists(self.part_path) and os.path.exists(self.map_path):
+            with open(self.map_path, "rb") as f:
+                mapa = bytearray(f.read())
+            if len(mapa) == self.total_partes and os.path.getsize(self.part_path) == self.file_size:
+                return mapa
+        # Pré-aloca o arquivo temporário com o tamanho final
+        with open(self.part_path, "wb") as f:
+            preallocar(f, self.file_size)
+        return bytearray(self.total_partes)
+
+    def _gravar_mapa(self, dados):
+        temporario = f"{self.map_path}.tmp"
+        with open(temporario, "wb") as f:
+            f.write(dados)
+        os.replace(temporario, self.map_path)
+
+    async def salvar_mapa(self):
+        # Uma gravação do mapa por vez; cada uma grava uma cópia do estado atual
+        self.alteracoes = 0
+        async with self.trava_mapa:
+            await em_disco(self._gravar_mapa, bytes(self.mapa))
+
+    def _gravar_parte(self, f, indice, chunk):
+        f.seek(indice * large_file_part_size)
+        f.write(chunk)
+        f.flush()
+        self._avancar_hash(indice, chunk)
+
+    def _avancar_hash(self, indice=None, chunk=None):
+        # Roda nas threads de disco. Partes além do prefixo ficam na memória até a vez delas (no máximo
+        # limite_fora_de_ordem); as que não couberem, e as retomadas de uma execução anterior, são relidas do
+        # ".part" quando o prefixo chega nelas.
+        with self.trava_hash:
+            if indice is not None:
+                self.gravadas[indice] = 1
+                if indice > self.proxima_hash and len(self.fora_de_ordem) < self.limite_fora_de_ordem:
+                    self.fora_de_ordem[indice] = chunk
+            leitura = None
+            try:
+                while self.proxima_hash < self.total_partes and self.gravadas[self.proxima_hash]:
+                    if self.proxima_hash == indice:
+                        dados = chunk
+                    elif self.proxima_hash in self.fora_de_ordem:
+                        dados = self.fora_de_ordem.pop(self.proxima_hash)
+                    else:
+                        if leitura is None:
+                            leitura = open(self.part_path, "rb")
+                        leitura.seek(self.proxima_hash * large_file_part_size)
+                        dados = leitura.read(self._tamanho_parte(self.proxima_hash))
+                    if len(self.inicio) < partial_hash_size:
+                        self.inicio += dados[:partial_hash_size - len(self.inicio)]
+                    self.sha256.update(dados)
+                    self.proxima_hash += 1
+            finally:
+                if leitura is not None:
+                    leitura.close()
+
+    async def _concluir_parte(self, f, indice, chunk, progress_callback):
+        # A parte só entra no mapa depois de gravada; uma interrupção nunca marca parte não escrita
+        await em_disco(self._gravar_parte, f, indice, chunk)
+        self.mapa[indice] = 1
+        self.recebidos += len(chunk)
+        self.alteracoes += 1
+        if self.alteracoes >= 32:
+            await self.salvar_mapa()
+        if progress_callback:
+            progress_callback(self.recebidos, self.file_size)
+
+    def segmentos_pendentes(self):
+        # Trechos de até large_file_segment_parts partes faltando, do começo para o fim do arquivo
+        segmentos = deque()
+        for indice, concluida in enumerate(self.mapa):
+            if concluida:
+                continue
+            if segmentos and indice == segmentos[-1][1] and indice - segmentos[-1][0] < large_file_segment_parts:
+                segmentos[-1][1] = indice + 1
             else:
-                channel_info = f"ID do Usuário: {channel.id}"
+                segmentos.append([indice, indice + 1])
+        return segmentos
 
-            # Inicializar a barra de progresso
-            progress_bar = tqdm(
-                total=file_size,
-                desc=f"Baixando {message.id}",
-                ncols=100,
+    def hexdigest(self):
+        return self.sha256.hexdigest() if self.proxima_hash == self.total_partes else None
+
+    def hash_parcial(self):
+        return hashlib.sha256(self.inicio).hexdigest()
+
+    async def _baixar_segmento(self, segmentos, progress_callback):
+        # A gravação de uma parte acontece enquanto a próxima é baixada (no máximo uma pendente por conexão)
+        f = await em_disco(open, self.part_path, "r+b")
+        gravacao = None
+        try:
+            while segmentos:
+                inicio, fim = segmentos.popleft()
+                while inicio < fim:
+                    try:
+                        async for chunk in self.message.client.iter_download(
+                                self.documento,
+                                offset=inicio * large_file_part_size,
+                                request_size=large_file_part_size,
+                                limit=fim - inicio,
+                                file_size=self.file_size,
+                        ):
+                            if gravacao is not None:
+                                await gravacao
+                            gravacao = asyncio.ensure_future(
+                                self._concluir_parte(f, inicio, chunk, progress_callback)
+                            )
+                            inicio += 1
+                            if inicio >= fim:
+                                break
+                        else:
+                            if inicio < fim:
+                                raise ValueError(f"download da parte {inicio} terminou antes do esperado")
+                    except FileReferenceExpiredError:
+                        # A referência do arquivo expira com o tempo; busca a mensagem de novo e continua
+                        atualizada = await self.message.client.get_messages(
+                            self.message.input_chat, ids=self.message.id
+                        )
+                        if not atualizada or not atualizada.document:
+                            raise
+                        self.documento = atualizada.document
+            if gravacao is not None:
+                await gravacao
+                gravacao = None
+        finally:
+            if gravacao is not None:
+                with contextlib.suppress(BaseException):
+                    await gravacao
+            await em_disco(f.close)
+
+    def _preparar(self):
+        self.mapa = self._carregar_mapa()
+        self.gravadas = bytearray(self.mapa)
+
+    async def baixar(self, progress_callback=None):
+        await em_disco(self._preparar)
+        segmentos = self.segmentos_pendentes()
+        tarefas = [
+            asyncio.create_task(self._baixar_segmento(segmentos, progress_callback))
+            for _ in range(min(large_file_connections, len(segmentos)))
+        ]
+        try:
+            await asyncio.gather(*tarefas)
+        finally:
+            for tarefa in tarefas:
+                tarefa.cancel()
+            await asyncio.gather(*tarefas, return_exceptions=True)
+            await self.salvar_mapa()
+
+        if not all(self.mapa):
+            return None
+        # Partes retomadas de uma execução anterior que ainda não entraram no hash
+        await em_disco(self._avancar_hash)
+        await confirmacao_disco.confirmar(self.part_path, self.file_path)
+        await em_disco(os.remove, self.map_path)
+        return self.file_path
+
+
+class ProgressoArquivo:
+    # Contador de bytes de um download; o callback do Telethon só soma, quem desenha é o RelatorioProgresso
+    __slots__ = ("relatorio", "controlador", "baixados")
+
+    def __init__(self, relatorio, controlador):
+        self.relatorio = relatorio
+        self.controlador = controlador
+        self.baixados = 0
+
+    def __call__(self, current, total):
+        if current > self.baixados:
+            self.relatorio.bytes_baixados += current - self.baixados
+            self.relatorio.bytes_por_controlador[self.controlador] += current - self.baixados
+            self.baixados = current
+
+
+class RelatorioProgresso:
+    # Progresso agregado de todos os downloads. Uma tarefa amostra os contadores a cada progress_refresh
+    # segundos, repassa os bytes ao controlador de concorrência de cada conta e desenha uma única barra; no
+    # modo headless registra um resumo estruturado a cada progress_interval segundos.
+    def __init__(self, controladores):
+        self.controladores = controladores
+        self.total_bytes = 0
+        self.bytes_baixados = 0
+        self.bytes_por_controlador = Counter()
+        self.arquivos = Counter()
+        self.inicio = time.monotonic()
+        self._amostrados = 0
+        self._ultimo_resumo = (self.inicio, 0)
+        self._barra = None
+        self._tarefa = None
+
+    def adicionar(self, file_size):
+        self.total_bytes += file_size
+
+    def iniciar_arquivo(self, controlador):
+        return ProgressoArquivo(self, controlador)
+
+    def em_andamento(self):
+        return sum(controlador.em_andamento for controlador in self.controladores)
+
+    def limite(self):
+        return sum(controlador.limite for controlador in self.controladores)
+
+    def registrar(self, status, file_size):
+        self.arquivos[status] += 1
+        if status in (ManifestoArquivo.DUPLICADO, ManifestoArquivo.PULADO):
+            # Nada a baixar: sai do total para a barra terminar em 100%
+            self.total_bytes -= file_size
+
+    async def __aenter__(self):
+        if not headless:
+            self._barra = tqdm(
+                total=0,
+                desc="Progresso Total",
                 unit="B",
                 unit_scale=True,
-                leave=False,
+                ncols=100,
                 bar_format=(
                         "{l_bar}%s{bar}%s| {n_fmt}/{total_fmt} {unit} "
-                        "| Tempo: {elapsed}/{remaining} | {rate_fmt}"
-                        % (Fore.BLUE, Style.RESET_ALL)
+                        "| Tempo: {elapsed}/{remaining} | {rate_fmt}{postfix}"
+                        % (Fore.MAGENTA, Style.RESET_ALL)
                 ),
             )
+        self._tarefa = asyncio.create_task(self._executar())
+        return self
 
-            # Baixar a mídia com progresso
-            file_path = await message.download_media(
-                file=f"{download_path_base}/{folder_name}/",
-                progress_callback=lambda current, total: (
-                    progress_bar.update(current - progress_bar.n),
-                    global_progress_bar.update(current - global_progress_bar.n),
-                ) if total else None,
-            )
+    async def __aexit__(self, exc_type, exc, tb):
+        self._tarefa.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._tarefa
+        self._amostrar()
+        if self._barra is not None:
+            self._barra.close()
+        else:
+            self._resumir("progresso final")
+
+    async def _executar(self):
+        while True:
+            await asyncio.sleep(progress_refresh)
+            self._amostrar()
+            if headless and time.monotonic() - self._ultimo_resumo[0] >= progress_interval:
+                self._resumir("progresso")
 
-            # Após o download, mudar a cor para verde
-            progress_bar.bar_format = (
-                    "{l_bar}%s{bar}%s| {n_fmt}/{total_fmt} {unit} "
-                    "| Tempo: {elapsed}/{rate_fmt}" % (Fore.GREEN, Style.RESET_ALL)
+    def _amostrar(self):
+        delta = self.bytes_baixados - self._amostrados
+        self._amostrados = self.bytes_baixados
+        # Também sem bytes novos: um travamento completo precisa derrubar a vazão medida
+        for controlador in self.controladores:
+            controlador.registrar_bytes(self.bytes_por_controlador.get(controlador, 0))
+        self.bytes_por_controlador.clear()
+        if delta:
+            metricas.incrementar("bytes_baixados_total", delta)
+        em_andamento = self.em_andamento()
+        metricas.definir("downloads_em_andamento", em_andamento)
+        metricas.definir("concorrencia_limite", self.limite())
+        if self._barra is not None:
+            self._barra.total = max(self.total_bytes, self.bytes_baixados)
+            self._barra.set_postfix_str(
+                f"{self.arquivos[ManifestoArquivo.CONCLUIDO]} arquivos, {em_andamento} ativos",
+                refresh=False,
             )
-            progress_bar.set_description(f"Finalizado {message.id}")
-            progress_bar.n = progress_bar.total
-            progress_bar.update(0)
+            if delta:
+                self._barra.update(delta)
+            else:
+                self._barra.refresh()
+
+    def _resumir(self, mensagem):
+        agora = time.monotonic()
+        instante, baixados = self._ultimo_resumo
+        self._ultimo_resumo = (agora, self.bytes_baixados)
+        evento(mensagem, dados={
+            "bytes_baixados": self.bytes_baixados,
+            "bytes_total": self.total_bytes,
+            "taxa_bps": round((self.bytes_baixados - baixados) / max(agora - instante, 1e-9)),
+            "arquivos": dict(self.arquivos),
+            "em_andamento": self.em_andamento(),
+            "concorrencia": self.limite(),
+            "paginas_historico": metricas.valor("paginas_historico_total"),
+            "fila": metricas.valor("fila_downloads"),
+            "duracao_s": round(agora - self.inicio, 1),
+        })
+
+
+async def baixar_arquivo(message, folder_name, relatorio, channel, manifesto, controlador, file_index,
+                         total_files):
+    # Mede o arquivo inteiro e cada fase; o resultado vai para as métricas e para o log de eventos
+    fases = Counter()
+    inicio = time.monotonic()
+    media_id, _ = identificar_midia(message)
+    # A espera por outro download da mesma mídia acontece fora do limite de concorrência
+    with cronometrar(fases, "espera"):
+        existente = await reservar_midia(media_id)
+    status = None
+    try:
+        status = await _baixar_arquivo(message, folder_name, relatorio, channel, manifesto, controlador, file_index,
+                                       total_files, fases, existente)
+    finally:
+        if media_id is not None and existente is None:
+            pronto = None
+            if status in (ManifestoArquivo.CONCLUIDO, ManifestoArquivo.DUPLICADO):
+                pronto = manifesto.arquivo_registrado(channel.id, message.id)
+            liberar_midia(media_id, pronto)
+    duracao = time.monotonic() - inicio
+    metricas.incrementar("arquivos_total", status=status)
+    metricas.observar("arquivo_duracao_segundos", duracao, status=status)
+    for fase, segundos in fases.items():
+        metricas.observar("fase_duracao_segundos", segundos, fase=fase)
+    evento(f"Arquivo {message.id}: {status}", nivel=logging.DEBUG, por_arquivo=True, dados={
+        "channel_id": channel.id,
+        "message_id": message.id,
+        "status": status,
+        "bytes": tamanho_midia(message),
+        "duracao_s": round(duracao, 3),
+        "fases_s": {fase: round(segundos, 3) for fase, segundos in fases.items()},
+    })
+    return status
+
+
+async def _baixar_arquivo(message, folder_name, relatorio, channel, manifesto, controlador, file_index,
+                          total_files, fases, existente=None):
+    # Extrair info do canal para logging
+    if hasattr(channel, "title"):
+        channel_info = f"Canal: {channel.title} (ID: {channel.id})"
+    elif hasattr(channel, "first_name"):
+        channel_info = f"Usuário: {channel.first_name} {channel.last_name} (ID: {channel.id})"
+    else:
+        channel_info = f"ID do Usuário: {channel.id}"
+
+    inicio = time.monotonic()
+    async with controlador:
+        fases["espera"] += time.monotonic() - inicio
+        file_path = None
+        destino = None
+        try:
+            # Obter o tamanho do arquivo
+            file_size = tamanho_midia(message)
+
+            if file_size > 6 * 1024 * 1024 * 1024:
+                evento(f"AVISO: Arquivo {file_index}/{total_files} - {message.id} é maior que 6GB ({file_size} bytes), "
+                       f"pulando download.", por_arquivo=True)
+                manifesto.registrar_resultado(channel.id, message.id, ManifestoArquivo.PULADO)
+                return ManifestoArquivo.PULADO
+
+            # Deduplicação antes do download: a mídia já existe no arquivo (deste ou de outro canal) ou acabou
+            # de ser baixada por um repost que estava em andamento
+            destino = await em_disco(caminho_destino, message, folder_name)
+            if destino in destinos_em_uso:
+                # Outro download reservou o mesmo nome enquanto este era calculado
+                stem, ext = os.path.splitext(destino)
+                destino = f"{stem} ({message.id}){ext}"
+            destinos_em_uso.add(destino)
+            with cronometrar(fases, "dedup"):
+                arquivo_original, sha_original = existente or await buscar_duplicado(message, manifesto, file_size)
+                if arquivo_original:
+                    vinculo, referencia = await em_disco(vincular_existente, arquivo_original, sha_original, destino)
+            if arquivo_original:
+                manifesto.registrar_resultado(channel.id, message.id, ManifestoArquivo.DUPLICADO,
+                                              sha256=sha_original, path=vinculo or referencia)
+                evento(f"AVISO: Arquivo {file_index}/{total_files} - {message.id} de {channel_info} já existe em "
+                       f"{arquivo_original}, pulando download.", por_arquivo=True)
+                return ManifestoArquivo.DUPLICADO
+
+            # O callback só atualiza um contador; o RelatorioProgresso amostra e desenha
+            progress_callback = relatorio.iniciar_arquivo(controlador)
+            # No layout cas o download vai para um temporário e só vira blob quando o hash é conhecido
+            alvo = caminho_temporario_cas(channel, message) if storage_layout == "cas" else destino
+
+            if message.document and file_size >= large_file_threshold:
+                # Arquivo grande: partes paralelas com retomada; o hash acompanha a gravação das partes
+                download = DownloadEmPartes(message, alvo, file_size,
+                                            caminho_retomada(channel, message, folder_name))
+                with cronometrar(fases, "transferencia"):
+                    file_path = await download.baixar(progress_callback)
+                if file_path:
+                    file_hash = download.hexdigest()
+                    hash_parcial = download.hash_parcial()
+            else:
+                # O hash é calculado enquanto os blocos são gravados, sem reler o arquivo do disco
+                sink = await ArquivoComHash(alvo, file_size).abrir()
+                try:
+                    with cronometrar(fases, "transferencia"):
+                        resultado = await message.download_media(file=sink, progress_callback=progress_callback)
+                    if resultado:
+                        with cronometrar(fases, "disco"):
+                            file_path = await sink.concluir()
+                        file_hash = sink.hexdigest()
+                        hash_parcial = sink.hash_parcial()
+                    else:
+                        await sink.descartar()
+                except BaseException:
+                    await sink.descartar()
+                    raise
+
+            if file_path and storage_layout == "cas":
+                with cronometrar(fases, "disco"):
+                    file_path = await em_disco(guardar_blob, file_path, file_hash, destino)
 
             if file_path:
-                file_hash = await calcular_hash_arquivo(file_path)
-                if file_hash:
-                    if file_hash in downloaded_hashes:
-                        os.remove(file_path)
-                        print(
-                            f"{Fore.YELLOW}AVISO: Arquivo {file_index}/{total_files} - {message.id} de {channel_info} é duplicado, pulando download.{Style.RESET_ALL}")
-                        logger.info(
-                            f"AVISO: Arquivo {file_index}/{total_files} - {message.id} de {channel_info} é duplicado, pulando download.")
-                        return
+                arquivo_original = manifesto.possui_hash(file_hash)
+                if arquivo_original and os.path.abspath(arquivo_original) != os.path.abspath(file_path):
+                    if storage_layout == "cas":
+                        # O conteúdo já foi guardado uma única vez em guardar_blob; a entrada do canal fica
+                        vinculo = file_path
                     else:
-                        downloaded_hashes[file_hash] = True
-                        if await verificar_integridade_arquivo(
-                                file_path,
-                                message.document.size if message.document else message.video.size,
-                        ):
-                            print(
-                                f"{Fore.GREEN}INFO: Arquivo {file_index}/{total_files} - {message.id} de {channel_info} baixado com sucesso!{Style.RESET_ALL}")
-                            logger.info(
-                                f"INFO: Arquivo {file_index}/{total_files} - {message.id} de {channel_info} baixado com sucesso!")
-                        else:
-                            print(
-                                f"{Fore.RED}ERRO: Arquivo {file_index}/{total_files} - {message.id} de {channel_info} baixado mas verificação de integridade falhou!{Style.RESET_ALL}")
-                            logger.error(
-                                f"ERRO: Arquivo {file_index}/{total_files} - {message.id} de {channel_info} baixado mas verificação de integridade falhou!")
+                        with cronometrar(fases, "disco"):
+                            await em_disco(os.remove, file_path)
+                            vinculo = await em_disco(vincular_duplicado, arquivo_original, file_path)
+                    manifesto.registrar_resultado(channel.id, message.id, ManifestoArquivo.DUPLICADO,
+                                                  sha256=file_hash, path=vinculo or arquivo_original)
+                    evento(f"AVISO: Arquivo {file_index}/{total_files} - {message.id} de {channel_info} é duplicado, "
+                           f"pulando download.", por_arquivo=True)
+                    return ManifestoArquivo.DUPLICADO
+                elif await verificar_integridade_arquivo(file_path, file_size):
+                    manifesto.registrar_resultado(channel.id, message.id, ManifestoArquivo.CONCLUIDO,
+                                                  sha256=file_hash, path=file_path,
+                                                  hash_parcial=hash_parcial)
+                    evento(f"INFO: Arquivo {file_index}/{total_files} - {message.id} de {channel_info} baixado com "
+                           f"sucesso!", Fore.GREEN, por_arquivo=True)
+                    return ManifestoArquivo.CONCLUIDO
                 else:
-                    print(
-                        f"{Fore.RED}ERRO: Arquivo {file_index}/{total_files} - {message.id} de {channel_info} - Falha ao calcular hash, pulando verificação de duplicados.{Style.RESET_ALL}")
-                    logger.error(
-                        f"ERRO: Arquivo {file_index}/{total_files} - {message.id} de {channel_info} - Falha ao calcular hash, pulando verificação de duplicados.")
+                    evento(f"ERRO: Arquivo {file_index}/{total_files} - {message.id} de {channel_info} baixado mas "
+                           f"verificação de integridade falhou!", nivel=logging.ERROR)
+                    # Remove o arquivo incompleto para que a nova tentativa não gere "nome (1).ext"
+                    await em_disco(os.remove, file_path)
+                    file_path = None
             else:
-                print(
-                    f"{Fore.RED}ERRO: Arquivo {file_index}/{total_files} - {message.id} de {channel_info} - Falha ao baixar arquivo {message.id}{Style.RESET_ALL}")
-                logger.error(
-                    f"ERRO: Arquivo {file_index}/{total_files} - {message.id} de {channel_info} - Falha ao baixar arquivo {message.id}")
+                evento(f"ERRO: Arquivo {file_index}/{total_files} - {message.id} de {channel_info} - Falha ao baixar "
+                       f"arquivo {message.id}", nivel=logging.ERROR)
 
         except FloodWaitError as e:
-            logger.error(f"Flood wait: {e}. Aguardando {e.seconds} segundos.")
-            print(f"{Fore.RED}Flood wait: {e}. Aguardando {e.seconds} segundos.{Style.RESET_ALL}")
-            await asyncio.sleep(e.seconds)
-            raise  # Re-raise para ser tratado na funcao baixar_todas_midias
+            evento(f"Flood wait: {e}. Aguardando {e.seconds} segundos.", nivel=logging.ERROR)
+            # O controlador pausa novos downloads; quem chamou reagenda só este arquivo
+            controlador.registrar_flood_wait(e.seconds)
+            raise
         except Exception as e:
-            logger.error(f"ERRO: Falha ao baixar mídia de {channel_info}: {e}")
-            print(f"{Fore.RED}ERRO: Falha ao baixar mídia de {channel_info}: {e}{Style.RESET_ALL}")
+            evento(f"ERRO: Falha ao baixar mídia de {channel_info}: {e}", nivel=logging.ERROR)
+        finally:
+            destinos_em_uso.discard(destino)
+
+        # Falhas ficam registradas para serem tentadas de novo na próxima execução
+        manifesto.registrar_resultado(channel.id, message.id, ManifestoArquivo.FALHA, path=file_path)
+        return ManifestoArquivo.FALHA
 
 
 async def verificar_integridade_arquivo(file_path, expected_size):
     try:
-        actual_size = os.path.getsize(file_path)
+        actual_size = await em_disco(os.path.getsize, file_path)
         return actual_size == expected_size
     except Exception as e:
-        logger.error(f"ERRO: Falha durante a verificação do tamanho do arquivo: {e}")
-        print(f"{Fore.RED}ERRO: Falha durante a verificação do tamanho do arquivo: {e}{Style.RESET_ALL}")
+        evento(f"ERRO: Falha durante a verificação do tamanho do arquivo: {e}", nivel=logging.ERROR)
         return False
 
 
-async def baixar_todas_midias(client, channel):
-    if hasattr(channel, "title"):
-        folder_name = channel.title
-    elif hasattr(channel, "first_name"):
-        folder_name = f"{channel.first_name} {channel.last_name}"
-    else:
-        folder_name = f"ID do Usuário: {channel.id}"
+async def obter_mensagens(client, channel, controlador, **kwargs):
+    # FloodWait na listagem do histórico: pausa as varreduras e repete só esta página
+    while True:
+        async with controlador.varredura():
+            try:
+                inicio = time.monotonic()
+                mensagens = await client.get_messages(channel, **kwargs)
+                metricas.observar("requisicao_historico_segundos", time.monotonic() - inicio)
+                metricas.incrementar("paginas_historico_total")
+                return mensagens
+            except FloodWaitError as e:
+                evento(f"Flood wait ao buscar mensagens: {e}. Aguardando {e.seconds} segundos.", nivel=logging.ERROR)
+                controlador.registrar_flood_wait_varredura(e.seconds)
+
+
+# Tipo de mídia -> filtros de busca aplicados no servidor (messages.search)
+FILTROS_MIDIA = {
+    "photos": [InputMessagesFilterPhotos],
+    "videos": [InputMessagesFilterVideo],
+    "documents": [InputMessagesFilterDocument],
+    "audio": [InputMessagesFilterMusic, InputMessagesFilterVoice],
+}
+
 
-    download_path = os.path.join(download_path_base, folder_name)
-    os.makedirs(download_path, exist_ok=True)
+class SelecaoMidia:
+    # Quais mídias baixar: tipos (vazio = todas), limites de tamanho em bytes e de data
+    def __init__(self, tipos=None, tamanho_minimo=None, tamanho_maximo=None, data_inicio=None, data_fim=None):
+        self.tipos = set(tipos or []) - {"all"}
+        invalidos = self.tipos - set(FILTROS_MIDIA)
+        if invalidos:
+            raise ValueError(f"Tipo de mídia inválido: {', '.join(sorted(invalidos))}")
+        self.tamanho_minimo = tamanho_minimo
+        self.tamanho_maximo = tamanho_maximo
+        self.data_inicio = data_inicio
+        self.data_fim = data_fim
 
-    print(f"{Fore.YELLOW}Buscando todas as mensagens com mídia...{Style.RESET_ALL}")
-    logger.info(f"Buscando todas as mensagens com mídia para {folder_name}")
+    @property
+    def limitada(self):
+        # Varreduras com limite de tamanho/data não cobrem o histórico todo e por isso não avançam o manifesto
+        return any(v is not None for v in (self.tamanho_minimo, self.tamanho_maximo, self.data_inicio, self.data_fim))
+
+    def filtros(self):
+        if not self.tipos:
+            return [("", None)]
+        filtros = {filtro for tipo in self.tipos for filtro in FILTROS_MIDIA[tipo]}
+        if {InputMessagesFilterPhotos, InputMessagesFilterVideo} <= filtros:
+            # Fotos + vídeos numa única busca
+            filtros -= {InputMessagesFilterPhotos, InputMessagesFilterVideo}
+            filtros.add(InputMessagesFilterPhotoVideo)
+        return sorted(((filtro.__name__, filtro()) for filtro in filtros), key=lambda item: item[0])
+
+    def aceita(self, message, verificar_tipo=True):
+        if verificar_tipo and self.tipos:
+            tipos = set()
+            if message.photo:
+                tipos.add("photos")
+            if message.video:
+                tipos.add("videos")
+            if message.audio or message.voice:
+                tipos.add("audio")
+            if message.document and not tipos:
+                tipos.add("documents")
+            if not tipos & self.tipos:
+                return False
+        file_size = tamanho_midia(message)
+        if self.tamanho_minimo is not None and file_size < self.tamanho_minimo:
+            return False
+        if self.tamanho_maximo is not None and file_size > self.tamanho_maximo:
+            return False
+        if self.data_inicio is not None and message.date < self.data_inicio:
+            return False
+        if self.data_fim is not None and message.date >= self.data_fim:
+            return False
+        return True
 
-    all_messages = []
-    offset_id = 0
 
-    downloaded_hashes = {}
+async def varrer_historico(client, channel, manifesto, controlador, offset_id, min_id, scan_topo,
+                           selecao, chave="", filtro=None):
+    # Percorre o histórico do mais novo para o mais antigo até min_id, registrando cada página no manifesto
+    # antes de entregá-la; assim uma execução interrompida pode continuar a partir de scan_offset.
+    # Com filtro, a busca é feita no servidor e só vêm mensagens do tipo pedido.
+    persistir = not selecao.limitada
     while True:
+        mensagens = await obter_mensagens(
+            client, channel, controlador, limit=100, offset_id=offset_id, min_id=min_id,
+            filter=filtro, offset_date=selecao.data_fim,
+        )
+        if not mensagens:
+            break
+        if scan_topo is None:
+            scan_topo = mensagens[0].id
+        novas = registrar_pagina(channel, manifesto, mensagens, selecao)
+        offset_id = mensagens[-1].id
+        if persistir:
+            manifesto.registrar_progresso_varredura(channel.id, scan_topo, offset_id, chave)
+        for message in novas:
+            yield message
+        if selecao.data_inicio is not None and mensagens[-1].date < selecao.data_inicio:
+            break
+        if scan_segments > 1 and len(mensagens) == 100 and offset_id - min_id > scan_segments * scan_segment_min_ids:
+            # A primeira página já mostrou o id mais novo: o resto do intervalo é varrido em faixas paralelas
+            async for message in varrer_faixas(client, channel, manifesto, controlador, offset_id, min_id,
+                                               scan_topo, selecao, chave, filtro):
+                yield message
+            break
+    if scan_topo is not None and persistir:
+        manifesto.concluir_varredura(channel.id, scan_topo, chave)
+
+
+def registrar_pagina(channel, manifesto, mensagens, selecao):
+    # Mídias ainda desconhecidas da página; ficam pendentes no manifesto antes de irem para a fila
+    novas = [
+        message for message in mensagens
+        if possui_arquivo(message) and selecao.aceita(message, verificar_tipo=False)
+        and manifesto.status(channel.id, message.id) is None
+    ]
+    manifesto.registrar_pendentes(channel.id, novas)
+    return novas
+
+
+class FaixaHistorico:
+    # Resultado de uma faixa de ids da varredura paralela, na ordem em que foi varrida. As primeiras
+    # scan_segment_buffer páginas guardam as mensagens; além disso a faixa guarda só os ids (em lotes de até
+    # 100), e as mensagens são buscadas de novo quando chega a vez dela. A memória fica limitada sem segurar
+    # a varredura das faixas mais antigas.
+    def __init__(self, inferior, superior):
+        self.inferior = inferior
+        self.superior = superior
+        self.paginas = deque()
+        self.concluida = False
+        self.erro = None
+        self.sinal = asyncio.Event()
+
+    def adicionar(self, novas, offset):
+        if len(self.paginas) < scan_segment_buffer:
+            self.paginas.append([novas, offset])
+        else:
+            ids = [message.id for message in novas]
+            ultima = self.paginas[-1]
+            if isinstance(ultima[0][0], int) and len(ultima[0]) + len(ids) <= 100:
+                ultima[0].extend(ids)
+                ultima[1] = offset
+            else:
+                self.paginas.append([ids, offset])
+        self.sinal.set()
+
+    def encerrar(self, erro=None):
+        self.concluida = True
+        self.erro = erro
+        self.sinal.set()
+
+    async def retirar(self):
+        while not self.paginas:
+            if self.concluida:
+                if self.erro is not None:
+                    raise self.erro
+                return None
+            self.sinal.clear()
+            await self.sinal.wait()
+        return self.paginas.popleft()
+
+
+async def varrer_faixas(client, channel, manifesto, controlador, offset_id, min_id, scan_topo, selecao, chave,
+                        filtro):
+    # Divide os ids entre min_id e offset_id em scan_segments faixas, cada uma varrida por uma tarefa com
+    # min_id/offset_id próprios (as chamadas continuam limitadas por controlador.varredura()). As faixas são
+    # entregues da mais nova para a mais antiga, então a ordem decrescente de uma varredura serial se mantém,
+    # e o progresso gravado no manifesto é sempre um prefixo contínuo do histórico.
+    persistir = not selecao.limitada
+    # min_id e offset_id são exclusivos no Telegram: cada faixa vai de inferior + 1 a superior - 1, e o
+    # superior de uma faixa é o inferior da anterior + 1 para que o id da divisa também seja buscado
+    passo = -(-(offset_id - min_id) // scan_segments)
+    faixas = [
+        FaixaHistorico(max(min_id, offset_id - passo * (i + 1)), offset_id - passo * i + (1 if i else 0))
+        for i in range(scan_segments) if offset_id - passo * i > min_id
+    ]
+
+    async def varrer(faixa):
         try:
-            media_messages = await client.get_messages(
-                channel, limit=100, offset_id=offset_id
-            )
-            if not media_messages:
-                break
-            all_messages.extend([msg for msg in media_messages if msg.media])
-            offset_id = media_messages[-1].id
+            offset = faixa.superior
+            while True:
+                mensagens = await obter_mensagens(
+                    client, channel, controlador, limit=100, offset_id=offset, min_id=faixa.inferior,
+                    filter=filtro, offset_date=selecao.data_fim,
+                )
+                if not mensagens:
+                    break
+                novas = registrar_pagina(channel, manifesto, mensagens, selecao)
+                offset = mensagens[-1].id
+                if novas:
+                    faixa.adicionar(novas, offset)
+                if selecao.data_inicio is not None and mensagens[-1].date < selecao.data_inicio:
+                    break
+            faixa.encerrar()
+        except Exception as e:
+            faixa.encerrar(e)
 
+    tarefas = [asyncio.create_task(varrer(faixa)) for faixa in faixas]
+    try:
+        for faixa in faixas:
+            while (pagina := await faixa.retirar()) is not None:
+                novas, offset = pagina
+                if isinstance(novas[0], int):
+                    novas = [
+                        message for message in await obter_mensagens(client, channel, controlador, ids=novas)
+                        if possui_arquivo(message)
+                    ]
+                if persistir:
+                    manifesto.registrar_progresso_varredura(channel.id, scan_topo, offset, chave)
+                for message in novas:
+                    yield message
+            # A faixa inteira foi entregue: a próxima começa abaixo de inferior + 1
+            if persistir:
+                manifesto.registrar_progresso_varredura(channel.id, scan_topo, faixa.inferior + 1, chave)
+    finally:
+        for tarefa in tarefas:
+            tarefa.cancel()
+
+
+async def varrer_filtro(client, channel, manifesto, controlador, selecao, chave, filtro):
+    ultimo_id, scan_topo, scan_offset = manifesto.estado_varredura(channel.id, chave)
+    if chave:
+        # Uma varredura completa do histórico também cobre qualquer filtro
+        ultimo_id = max(ultimo_id, manifesto.estado_varredura(channel.id)[0])
+
+    # Varredura interrompida: continua de onde parou
+    if scan_topo is not None and not selecao.limitada:
+        async for message in varrer_historico(client, channel, manifesto, controlador, scan_offset, ultimo_id,
+                                              scan_topo, selecao, chave, filtro):
+            yield message
+        ultimo_id = max(ultimo_id, scan_topo)
+
+    # Somente mensagens mais novas que a última varredura concluída
+    async for message in varrer_historico(client, channel, manifesto, controlador, 0, ultimo_id, None,
+                                          selecao, chave, filtro):
+        yield message
+
+
+async def mesclar_fluxos(fluxos):
+    # Consome vários geradores ao mesmo tempo e entrega os itens conforme chegam
+    fila = asyncio.Queue(maxsize=100)
+    fim = object()
+
+    async def consumir(fluxo):
+        try:
+            async for item in fluxo:
+                await fila.put(item)
         except Exception as e:
-            logger.error(f"ERRO: Falha ao buscar mensagens: {e}")
-            print(f"{Fore.RED}ERRO: Falha ao buscar mensagens: {e}{Style.RESET_ALL}")
-            break
+            evento(f"ERRO: Falha ao buscar mensagens: {e}", nivel=logging.ERROR)
+        finally:
+            await fila.put(fim)
 
-    print(f"Foram encontradas {len(all_messages)} mensagens com mídia em ", end="")
+    tarefas = [asyncio.create_task(consumir(fluxo)) for fluxo in fluxos]
+    restantes = len(tarefas)
+    try:
+        while restantes:
+            item = await fila.get()
+            if item is fim:
+                restantes -= 1
+                continue
+            yield item
+    finally:
+        for tarefa in tarefas:
+            tarefa.cancel()
+
+
+async def gerar_mensagens_midia(client, channel, manifesto, controlador, selecao=None):
+    selecao = selecao or SelecaoMidia()
+    try:
+        # 1. Mídias pendentes ou com falha de execuções anteriores (as fora da seleção continuam pendentes)
+        pendentes = manifesto.pendentes(channel.id)
+        for i in range(0, len(pendentes), 100):
+            ids = pendentes[i:i + 100]
+            mensagens = await obter_mensagens(client, channel, controlador, ids=ids)
+            for message_id, message in zip(ids, mensagens):
+                if not possui_arquivo(message):
+                    manifesto.registrar_resultado(channel.id, message_id, ManifestoArquivo.INDISPONIVEL)
+                    continue
+                if selecao.aceita(message):
+                    yield message
+
+        # 2. Uma varredura por filtro; vários filtros rodam em paralelo
+        fluxos = [
+            varrer_filtro(client, channel, manifesto, controlador, selecao, chave, filtro)
+            for chave, filtro in selecao.filtros()
+        ]
+        origem = fluxos[0] if len(fluxos) == 1 else mesclar_fluxos(fluxos)
+        async for message in origem:
+            yield message
+    except Exception as e:
+        evento(f"ERRO: Falha ao buscar mensagens: {e}", nivel=logging.ERROR)
+
+
+async def gerar_mensagens_novas(channel, manifesto, fila, selecao=None):
+    # Mensagens recebidas ao vivo (events.NewMessage); as que a varredura já registrou são ignoradas
+    selecao = selecao or SelecaoMidia()
+    while True:
+        message = await fila.get()
+        if not possui_arquivo(message) or manifesto.status(channel.id, message.id) is not None:
+            continue
+        if not selecao.aceita(message):
+            continue
+        manifesto.registrar_pendentes(channel.id, [message])
+        yield message
+
+
+def nome_pasta(channel):
     if hasattr(channel, "title"):
-        print(f"canal {channel.title}.")
+        return channel.title
     elif hasattr(channel, "first_name"):
-        print(f"usuário {channel.first_name} {channel.last_name}.")
-    else:
-        print(f"ID do usuário: {channel.id}")
+        return f"{channel.first_name} {channel.last_name}"
+    return f"ID do Usuário: {channel.id}"
 
-    print(f"{Fore.YELLOW}---------------------------------------------------------------------{Style.RESET_ALL}")
 
-    if all_messages:
-        total_size = sum(
-            msg.video.size if msg.video else msg.document.size
-            for msg in all_messages
-            if msg.video or msg.document
-        )
-        print(
-            f"{Fore.YELLOW}Iniciando o download de {len(all_messages)} arquivos de mídia, tamanho total: {total_size} bytes...{Style.RESET_ALL}"
-        )
-        logger.info(f"Iniciando o download de {len(all_messages)} arquivos de mídia.")
+class ArquivamentoCanal:
+    # Estado de um canal dentro de um lote: andamento da varredura e resultado dos downloads
+    def __init__(self, channel, peso=1, mensagens=None, selecao=None, conta=None):
+        self.channel = channel
+        self.peso = max(1, peso)
+        self.mensagens = mensagens  # origem alternativa das mensagens (ex.: eventos ao vivo)
+        self.selecao = selecao or SelecaoMidia()
+        self.conta = conta  # conta que varre o canal e, por padrão, baixa suas mídias
+        self.revogacao = asyncio.Event()  # arrendamento do canal perdido para outro processo
+        self.downloads = set()
+        self.folder_name = nome_pasta(channel)
+        self.encontradas = 0
+        self.tamanho_total = 0
+        self.bytes_baixados = 0
+        self.varredura_concluida = False
+        self.resultados = Counter()
+        self.inicio = time.monotonic()
+        self.fim = None
 
-        file_index = 0
-        total_files = len(all_messages)
+    def total_files(self):
+        return self.encontradas if self.varredura_concluida else "?"
 
-        with tqdm(
-                total=total_size,
-                desc="Progresso Total",
-                unit="B",
-                unit_scale=True,
-                ncols=100,
-                bar_format=(
-                        "{l_bar}%s{bar}%s| {n_fmt}/{total_fmt} {unit} "
-                        "| Tempo: {elapsed}/{remaining} | {rate_fmt}"
-                        % (Fore.MAGENTA, Style.RESET_ALL)
-                ),
-        ) as global_progress_bar:
-
-            batch_size = 20  # Define o tamanho do lote (voce pode ajustar)
-            for i in range(0, len(all_messages), batch_size):
-                batch = all_messages[i:i + batch_size]
-                tasks = [
-                    baixar_arquivo(message, folder_name, global_progress_bar, channel, downloaded_hashes,
-                                   file_index + i + j + 1, total_files)
-                    for j, message in enumerate(batch)
-                ]
-                try:
-                    await asyncio.gather(*tasks)
-                except FloodWaitError:
-                    await baixar_todas_midias(client, channel)  # Re-run function
+    def revogar(self):
+        self.revogacao.set()
+
+    def registrar(self, status, file_size):
+        self.resultados[status] += 1
+        if status == ManifestoArquivo.CONCLUIDO:
+            self.bytes_baixados += file_size
+
+    def resumo(self):
+        fim = self.fim or time.monotonic()
+        return {
+            "canal": self.folder_name,
+            "id": self.channel.id,
+            "conta": self.conta.nome if self.conta else None,
+            "encontradas": self.encontradas,
+            "baixados": self.resultados[ManifestoArquivo.CONCLUIDO],
+            "duplicados": self.resultados[ManifestoArquivo.DUPLICADO],
+            "pulados": self.resultados[ManifestoArquivo.PULADO],
+            "falhas": self.resultados[ManifestoArquivo.FALHA],
+            "bytes_baixados": self.bytes_baixados,
+            "duracao_s": round(fim - self.inicio, 1),
+        }
+
+
+class AgendadorCanais:
+    # Round-robin ponderado entre canais: cada canal tem sua própria fila limitada e, a cada volta,
+    # entrega até `peso` arquivos antes de passar a vez. Um canal enorme não segura os outros, e canais
+    # sem nada na fila são pulados.
+    def __init__(self, tamanho_fila):
+        self.tamanho_fila = tamanho_fila
+        self.filas = {}
+        self.creditos = {}
+        self.rodada = deque()
+        self.enfileirados = 0
+        self.produtores_ativos = 0
+        self.condicao = asyncio.Condition()
+
+    def adicionar_canal(self, arquivamento):
+        self.filas[arquivamento] = deque()
+        self.creditos[arquivamento] = arquivamento.peso
+        self.rodada.append(arquivamento)
+        self.produtores_ativos += 1
+
+    async def colocar(self, arquivamento, item):
+        async with self.condicao:
+            fila = self.filas[arquivamento]
+            while len(fila) >= self.tamanho_fila:
+                await self.condicao.wait()
+            fila.append(item)
+            self.enfileirados += 1
+            metricas.definir("fila_downloads", self.enfileirados)
+            self.condicao.notify_all()
+
+    async def descartar_canal(self, arquivamento):
+        # Canal revogado: o que estava na fila é descartado e ele sai do round-robin
+        async with self.condicao:
+            fila = self.filas[arquivamento]
+            self.enfileirados -= len(fila)
+            fila.clear()
+            metricas.definir("fila_downloads", self.enfileirados)
+            if arquivamento in self.rodada:
+                self.rodada.remove(arquivamento)
+            self.condicao.notify_all()
 
+    async def encerrar_canal(self, arquivamento):
+        async with self.condicao:
+            self.produtores_ativos -= 1
+            self.condicao.notify_all()
+
+    async def retirar(self):
+        async with self.condicao:
+            while True:
+                for _ in range(len(self.rodada)):
+                    if not self.rodada:
+                        break
+                    arquivamento = self.rodada[0]
+                    fila = self.filas[arquivamento]
+                    if fila:
+                        item = fila.popleft()
+                        self.enfileirados -= 1
+                        metricas.definir("fila_downloads", self.enfileirados)
+                        self.creditos[arquivamento] -= 1
+                        if self.creditos[arquivamento] <= 0:
+                            self.creditos[arquivamento] = arquivamento.peso
+                            self.rodada.rotate(-1)
+                        self.condicao.notify_all()
+                        return arquivamento, item
+                    self.creditos[arquivamento] = arquivamento.peso
+                    if arquivamento.varredura_concluida:
+                        self.rodada.popleft()
+                    else:
+                        self.rodada.rotate(-1)
+                if self.produtores_ativos == 0 and not self.rodada:
+                    return None
+                await self.condicao.wait()
+
+
+async def arquivar_canais(client, arquivamentos, manifesto, controlador, contas=None):
+    # Todos os canais compartilham o mesmo orçamento de downloads e são atendidos em round-robin. Com várias
+    # contas, cada uma tem seu controlador e seus workers, e todas retiram da mesma fila.
+    contas = contas or [ContaTelegram(session_name, client, controlador)]
+    for arquivamento in arquivamentos:
+        arquivamento.conta = arquivamento.conta or contas[0]
+        arquivamento.conta.entidades.setdefault(utils.get_peer_id(arquivamento.channel), arquivamento.channel)
+        await em_disco(os.makedirs, os.path.join(download_path_base, arquivamento.folder_name), exist_ok=True)
+    if storage_layout == "cas":
+        await em_disco(os.makedirs, os.path.join(download_path_base, cas_dir_name, "tmp"), exist_ok=True)
+
+    # Há um worker por slot possível; o controlador de cada conta decide quantos baixam ao mesmo tempo
+    slots = sum(conta.controlador.limite_maximo for conta in contas)
+    agendador = AgendadorCanais(tamanho_fila=max(2, slots // len(arquivamentos)))
+
+    async with RelatorioProgresso([conta.controlador for conta in contas]) as relatorio:
+
+        async def produtor(arquivamento):
+            if arquivamento.mensagens is None:
+                conta = arquivamento.conta
+                channel = await conta.entidade(arquivamento.channel) or arquivamento.channel
+                origem = gerar_mensagens_midia(conta.client, channel, manifesto, conta.controlador,
+                                               arquivamento.selecao)
+            else:
+                origem = arquivamento.mensagens
+            try:
+                async for message in origem:
+                    arquivamento.encontradas += 1
+                    file_size = tamanho_midia(message)
+                    arquivamento.tamanho_total += file_size
+                    relatorio.adicionar(file_size)
+                    await agendador.colocar(arquivamento, (arquivamento.encontradas, message))
+            except asyncio.CancelledError:
+                if not arquivamento.revogacao.is_set():
+                    raise
+            finally:
+                arquivamento.varredura_concluida = True
+                await agendador.encerrar_canal(arquivamento)
+
+        async def escolher_conta(conta, arquivamento, message):
+            # Baixa pela conta dona do canal enquanto ela tem slot livre; se ela está em FloodWait ou saturada,
+            # a conta deste worker busca a mensagem de novo (se tiver acesso ao canal) e baixa no lugar dela
+            dono = arquivamento.conta
+            if conta is dono or dono.controlador.livre() or not conta.controlador.livre():
+                return dono, message
+            try:
+                recarregada = await conta.recarregar(arquivamento.channel, message)
+            except Exception as e:
+                evento(f"AVISO: Conta {conta.nome} não conseguiu buscar a mensagem {message.id}: {e}",
+                       nivel=logging.WARNING)
+                recarregada = None
+            if recarregada is None:
+                return dono, message
+            return conta, recarregada
+
+        async def worker(conta):
+            while True:
+                item = await agendador.retirar()
+                if item is None:
+                    return
+                arquivamento, (file_index, message) = item
+                while not arquivamento.revogacao.is_set():
+                    executora, mensagem = await escolher_conta(conta, arquivamento, message)
+                    # Cada download é uma tarefa própria para poder ser cancelado se o canal for revogado
+                    download = asyncio.create_task(baixar_arquivo(
+                        mensagem, arquivamento.folder_name, relatorio, arquivamento.channel, manifesto,
+                        executora.controlador, file_index, arquivamento.total_files(),
+                    ))
+                    arquivamento.downloads.add(download)
+                    try:
+                        await asyncio.wait({download})
+                    finally:
+                        arquivamento.downloads.discard(download)
+                        download.cancel()
+                    if download.cancelled():
+                        break
+                    try:
+                        status = download.result()
+                        arquivamento.registrar(status, tamanho_midia(message))
+                        relatorio.registrar(status, tamanho_midia(message))
+                        break
+                    except FloodWaitError:
+                        # O controlador segura a nova tentativa até o fim do flood wait
+                        continue
+
+        async def vigiar(arquivamento, produtor_canal):
+            # O arrendamento foi perdido (outro processo assumiu o canal ou pode assumi-lo): para a varredura,
+            # esvazia a fila e cancela os downloads dele
+            await arquivamento.revogacao.wait()
+            evento(f"AVISO: {arquivamento.folder_name} perdeu o arrendamento para outros processos; canal interrompido",
+                   nivel=logging.WARNING)
+            produtor_canal.cancel()
+            await agendador.descartar_canal(arquivamento)
+            for download in list(arquivamento.downloads):
+                download.cancel()
+
+        for arquivamento in arquivamentos:
+            agendador.adicionar_canal(arquivamento)
+        produtores = [asyncio.create_task(produtor(arquivamento)) for arquivamento in arquivamentos]
+        vigias = [asyncio.create_task(vigiar(a, tarefa)) for a, tarefa in zip(arquivamentos, produtores)]
+        workers = [
+            asyncio.create_task(worker(conta)) for conta in contas for _ in range(conta.controlador.limite_maximo)
+        ]
+        try:
+            await asyncio.gather(*produtores)
+            await asyncio.gather(*workers)
+        finally:
+            for task in produtores + vigias + workers:
+                task.cancel()
+            fim = time.monotonic()
+            for arquivamento in arquivamentos:
+                arquivamento.fim = fim
+
+
+def imprimir_resultado_canal(arquivamento, controlador):
+    channel = arquivamento.channel
+    if arquivamento.encontradas:
+        if hasattr(channel, "title"):
+            origem = f"canal {channel.title}"
+        elif hasattr(channel, "first_name"):
+            origem = f"usuário {channel.first_name} {channel.last_name}"
+        else:
+            origem = f"ID do usuário: {channel.id}"
+        resumo = controlador.resumo()
+        evento(
+            f"Foram encontradas {arquivamento.encontradas} mensagens com mídia em {origem}, tamanho total: "
+            f"{arquivamento.tamanho_total} bytes. Concorrência final: {resumo['limite']}, "
+            f"média {resumo['taxa_media'] / 1024 / 1024:.2f} MB/s, {resumo['flood_waits']} flood waits "
+            f"({resumo['tempo_flood_wait']:.0f}s)", Fore.GREEN, dados=arquivamento.resumo())
     else:
-        print(f"{Fore.RED}Nenhuma mídia encontrada para o tipo selecionado.{Style.RESET_ALL}")
-        logger.info(f"Nenhuma mídia encontrada para o tipo selecionado.")
-    print(f"{Fore.YELLOW}---------------------------------------------------------------------{Style.RESET_ALL}")
+        evento("Nenhuma mídia encontrada para o tipo selecionado.", Fore.RED)
+
+
+async def baixar_todas_midias(client, channel, manifesto=None, controlador=None, selecao=None):
+    arquivamento = ArquivamentoCanal(channel, selecao=selecao)
+    if controlador is None:
+        controlador = ControladorConcorrencia()
+
+    evento(
+        f"Buscando mensagens com mídia para {arquivamento.folder_name} (download em streaming, "
+        f"{controlador.limite} downloads simultâneos, até {controlador.limite_maximo})")
+    if not headless:
+        print(f"{Fore.YELLOW}---------------------------------------------------------------------{Style.RESET_ALL}")
+
+    manifesto_proprio = manifesto is None
+    if manifesto_proprio:
+        manifesto = abrir_manifesto()
+    try:
+        await arquivar_canais(client, [arquivamento], manifesto, controlador)
+    finally:
+        if manifesto_proprio:
+            manifesto.close()
+
+    imprimir_resultado_canal(arquivamento, controlador)
+    if not headless:
+        print(f"{Fore.YELLOW}---------------------------------------------------------------------{Style.RESET_ALL}")
+    return arquivamento
 
 
 async def main():
-    print(f"{Fore.YELLOW}Conectando ao Telegram...{Style.RESET_ALL}")
-    logger.info("Conectando ao Telegram...")
+    evento("Conectando ao Telegram...")
     try:
-        async with TelegramClient(session_name, api_id, api_hash) as client:
-            print(f"{Fore.GREEN}Conectado com sucesso!{Style.RESET_ALL}")
-            logger.info("Conectado ao Telegram com sucesso!")
+        async with servidor_metricas(), TelegramClient(session_name, api_id, api_hash,
+                                                         flood_sleep_threshold=flood_sleep_threshold) as client:
+            evento("Conectado com sucesso!", Fore.GREEN)
 
-            while True:
-                action = input(
-                    f"{Fore.CYAN}Digite 'listar' para listar canais/grupos ou 'baixar' para baixar mídias: {Style.RESET_ALL}"
-                ).lower()
-
-                if action == "listar":
-                    available_channels = await listar_canais_disponiveis(client)
-                    if available_channels:
-                        channel_choice = input(
-                            f"{Fore.CYAN}Digite o número ou o nome/username do canal que você quer baixar: {Style.RESET_ALL}"
+            # Um único manifesto para a sessão: guarda o estado dos downloads e o cache de entidades
+            with contextlib.closing(abrir_manifesto()) as manifesto:
+                while True:
+                    action = input(
+                        f"{Fore.CYAN}Digite 'listar' para listar canais/grupos ('atualizar' para buscar a lista de novo no Telegram) ou 'baixar' para baixar mídias: {Style.RESET_ALL}"
+                    ).lower()
+
+                    if action in ("listar", "atualizar"):
+                        available_channels = await listar_canais_disponiveis(
+                            client, manifesto, atualizar=action == "atualizar"
                         )
-                        try:
-                            channel_index = int(channel_choice) - 1
-                            if 0 <= channel_index < len(available_channels):
-                                channel = available_channels[channel_index]
-                            else:
-                                raise ValueError("Número inválido")
-                        except ValueError:
+                        if available_channels:
+                            channel_choice = input(
+                                f"{Fore.CYAN}Digite o número ou o nome/username do canal que você quer baixar: {Style.RESET_ALL}"
+                            )
                             try:
-                                channel = next(
-                                    entity
-                                    for entity in available_channels
-                                    if (
-                                            hasattr(entity, "title")
-                                            and entity.title == channel_choice
+                                channel_index = int(channel_choice) - 1
+                                if 0 <= channel_index < len(available_channels):
+                                    channel = available_channels[channel_index]
+                                else:
+                                    raise ValueError("Número inválido")
+                            except ValueError:
+                                try:
+                                    channel = next(
+                                        entity
+                                        for entity in available_channels
+                                        if (
+                                                hasattr(entity, "title")
+                                                and entity.title == channel_choice
+                                        )
+                                        or (
+                                                hasattr(entity, "first_name")
+                                                and f"{entity.first_name} {entity.last_name}"
+                                                == channel_choice
+                                        )
+                                        or str(entity.id) == channel_choice
                                     )
-                                    or (
-                                            hasattr(entity, "first_name")
-                                            and f"{entity.first_name} {entity.last_name}"
-                                            == channel_choice
-                                    )
-                                    or str(entity.id) == channel_choice
+                                except StopIteration:
+                                    evento(f"Canal não encontrado: {channel_choice}", nivel=logging.ERROR)
+                                    continue
+
+                            print(f"{Fore.YELLOW}Canal selecionado: ", end="")
+                            if hasattr(channel, "title"):
+                                print(
+                                    f"{channel.title} (ID: {channel.id}){Style.RESET_ALL}"
                                 )
-                            except StopIteration:
-                                print(f"{Fore.RED}Canal não encontrado.{Style.RESET_ALL}")
-                                logger.error(f"Canal não encontrado: {channel_choice}")
-                                continue
-
-                        print(f"{Fore.YELLOW}Canal selecionado: ", end="")
-                        if hasattr(channel, "title"):
-                            print(
-                                f"{channel.title} (ID: {channel.id}){Style.RESET_ALL}"
-                            )
-                        elif hasattr(channel, "first_name"):
-                            print(
-                                f"{channel.first_name} {channel.last_name} (ID: {channel.id}){Style.RESET_ALL}"
-                            )
-                        else:
-                            print(f"ID do usuário: {channel.id}{Style.RESET_ALL}")
+                            elif hasattr(channel, "first_name"):
+                                print(
+                                    f"{channel.first_name} {channel.last_name} (ID: {channel.id}){Style.RESET_ALL}"
+                                )
+                            else:
+                                print(f"ID do usuário: {channel.id}{Style.RESET_ALL}")
 
-                        await baixar_todas_midias(client, channel)
-                        break
-                elif action == "baixar":
-                    channel_username = input(
-                        f"{Fore.CYAN}Digite o nome ou username do canal: {Style.RESET_ALL}"
-                    )
-                    try:
-                        channel = await client.get_entity(channel_username)
-                        print(
-                            f"{Fore.YELLOW}Canal encontrado: {channel.title} (ID: {channel.id}){Style.RESET_ALL}"
+                            await baixar_todas_midias(client, channel, manifesto, selecao=perguntar_selecao())
+                            break
+                    elif action == "baixar":
+                        channel_username = input(
+                            f"{Fore.CYAN}Digite o nome ou username do canal: {Style.RESET_ALL}"
                         )
-                        logger.info(f"Canal encontrado: {channel.title} (ID: {channel.id})")
-                    except ValueError:
-                        print(f"{Fore.RED}Username do canal inválido. Saindo...{Style.RESET_ALL}")
-                        logger.error(f"Username do canal inválido: {channel_username}")
-                        continue
-                    except Exception as e:
-                        print(f"{Fore.RED}Ocorreu um erro: {e}{Style.RESET_ALL}")
-                        logger.error(f"Ocorreu um erro: {e}")
+                        try:
+                            channel = await resolver_canal(client, channel_username, manifesto)
+                            evento(f"Canal encontrado: {nome_pasta(channel)} (ID: {channel.id})")
+                        except ValueError:
+                            evento(f"Username do canal inválido: {channel_username}", nivel=logging.ERROR)
+                            continue
+                        except Exception as e:
+                            evento(f"Ocorreu um erro: {e}", nivel=logging.ERROR)
+                            continue
+
+                        await baixar_todas_midias(client, channel, manifesto, selecao=perguntar_selecao())
+                        break
+                    else:
+                        evento(f"Comando inválido digitado: {action}", nivel=logging.ERROR)
                         continue
 
-                    await baixar_todas_midias(client, channel)
-                    break
+    except Exception as e:
+        evento(f"Falha ao conectar, ocorreu um erro: {e}", nivel=logging.ERROR)
+
+
+async def resolver_canal(client, referencia, manifesto):
+    # Aceita username, link ou ID numérico (inclusive no formato -100...); o cache local de entidades
+    # evita uma requisição ResolveUsername/GetChannels para cada canal já conhecido
+    try:
+        referencia = int(referencia)
+    except ValueError:
+        pass
+    entity = manifesto.buscar_entidade(referencia, entity_cache_ttl)
+    if entity is None:
+        entity = await aguardando_flood_wait(client.get_entity, referencia)
+        manifesto.salvar_entidades([entity])
+    return entity
+
+
+def interpretar_pesos(pesos):
+    # "--weight canal=3": o canal recebe 3 arquivos por volta do round-robin
+    resultado = {}
+    for item in pesos:
+        referencia, _, peso = item.rpartition("=")
+        try:
+            resultado[referencia] = int(peso)
+        except ValueError:
+            raise ValueError(f"Peso inválido: {item} (use CANAL=PESO)")
+    return resultado
+
+
+def interpretar_data(texto):
+    # "AAAA-MM-DD" em UTC, comparável com message.date
+    try:
+        return datetime.datetime.strptime(texto, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)
+    except ValueError:
+        raise ValueError(f"Data inválida: {texto} (use AAAA-MM-DD)")
+
+
+def interpretar_selecao(args):
+    tipos = [tipo.strip() for tipo in args.types.split(",") if tipo.strip()] if args.types else []
+    data_fim = interpretar_data(args.until) + datetime.timedelta(days=1) if args.until else None
+    return SelecaoMidia(
+        tipos=tipos,
+        tamanho_minimo=int(args.min_size * 1024 * 1024) if args.min_size is not None else None,
+        tamanho_maximo=int(args.max_size * 1024 * 1024) if args.max_size is not None else None,
+        data_inicio=interpretar_data(args.since) if args.since else None,
+        data_fim=data_fim,
+    )
+
+
+def perguntar_selecao():
+    tipos = input(
+        f"{Fore.CYAN}Tipos de mídia ({', '.join(FILTROS_MIDIA)}; separados por vírgula, Enter para todos): "
+        f"{Style.RESET_ALL}"
+    )
+    try:
+        return SelecaoMidia(tipos=[tipo.strip() for tipo in tipos.split(",") if tipo.strip()])
+    except ValueError as e:
+        evento(f"{e}. Baixando todos os tipos.", nivel=logging.ERROR)
+        return SelecaoMidia()
+
+
+def escrever_resumo_lote(arquivamentos, controlador, arquivo_resumo=None, contas=None):
+    if arquivo_resumo is None:
+        arquivo_resumo = os.path.join(download_path_base, f"resumo_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    resumo = {"controlador": controlador.resumo(), "canais": [a.resumo() for a in arquivamentos]}
+    if contas and len(contas) > 1:
+        resumo["contas"] = {conta.nome: conta.controlador.resumo() for conta in contas}
+    with open(arquivo_resumo, "w", encoding="utf-8") as f:
+        json.dump(resumo, f, ensure_ascii=False, indent=2)
+
+    for item in resumo["canais"]:
+        evento(
+            f"Resumo de {item['canal']} (ID: {item['id']}): {item['encontradas']} mídias, "
+            f"{item['baixados']} baixadas, {item['duplicados']} duplicadas, {item['pulados']} puladas, "
+            f"{item['falhas']} falhas, {item['bytes_baixados']} bytes em {item['duracao_s']}s",
+            Fore.GREEN, dados=item,
+        )
+    evento(f"Resumo salvo em {arquivo_resumo}")
+
+
+@contextlib.asynccontextmanager
+async def manter_arrendamentos(manifesto, recursos):
+    # Renova os arrendamentos enquanto o lote roda e os libera no fim; se o processo morrer, eles expiram
+    # em lease_ttl segundos e outro processo pode assumir os canais. recursos: recurso -> arquivamentos;
+    # um arrendamento que não pode ser renovado revoga os canais dele neste processo.
+    intervalo = lease_ttl / 3
+
+    async def renovar():
+        renovados = dict.fromkeys(recursos, time.monotonic())
+        while True:
+            await asyncio.sleep(intervalo)
+            for recurso, arquivamentos in list(recursos.items()):
+                try:
+                    arrendado = manifesto.arrendar(recurso, worker_id, lease_ttl)
+                except sqlite3.OperationalError as e:
+                    # Manifesto travado por outro processo: tenta de novo na próxima volta enquanto o
+                    # arrendamento ainda estiver valendo até lá; senão outro processo pode assumir o canal
+                    if time.monotonic() - renovados[recurso] + intervalo < lease_ttl:
+                        evento(f"AVISO: Falha ao renovar o arrendamento de {recurso} ({e}), tentando de novo",
+                               nivel=logging.WARNING)
+                        continue
+                    evento(f"AVISO: Arrendamento de {recurso} vai expirar sem renovação ({e})",
+                           nivel=logging.WARNING)
+                    arrendado = False
                 else:
-                    print(
-                        f"{Fore.RED}Ops, não identifiquei esse comando. Tente novamente com 'listar' ou 'baixar'.{Style.RESET_ALL}")
-                    logger.error(f"Comando inválido digitado: {action}")
+                    if not arrendado:
+                        evento(f"AVISO: Arrendamento de {recurso} foi assumido por outro processo",
+                               nivel=logging.WARNING)
+                if arrendado:
+                    renovados[recurso] = time.monotonic()
                     continue
+                del recursos[recurso]
+                for arquivamento in arquivamentos:
+                    arquivamento.revogar()
+
+    tarefa = asyncio.create_task(renovar())
+    try:
+        yield
+    finally:
+        tarefa.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await tarefa
+        for recurso in recursos:
+            # Se o manifesto continuar travado, o arrendamento só expira em lease_ttl segundos
+            with contextlib.suppress(sqlite3.OperationalError):
+                manifesto.liberar(recurso, worker_id)
+
+
+async def arquivar_lote(client, referencias, todos_dialogos=False, pesos=None, acompanhar=False,
+                        arquivo_resumo=None, selecao=None, contas=None):
+    pesos = pesos or {}
+    manifesto = abrir_manifesto()
+    # A primeira conta resolve os canais (e recebe os eventos ao vivo); as outras dividem varredura e downloads
+    contas = contas or [ContaTelegram(session_name, client)]
+    client = contas[0].client
+    controlador = contas[0].controlador
+    try:
+        canais = []
+        for referencia in referencias:
+            try:
+                canais.append((await resolver_canal(client, referencia, manifesto), pesos.get(referencia, 1)))
+            except Exception as e:
+                evento(f"Canal não encontrado: {referencia} ({e})", nivel=logging.ERROR)
+        if todos_dialogos:
+            canais.extend((entity, 1) for entity in await listar_canais_disponiveis(client, manifesto))
+
+        # O mesmo canal pode vir pela lista e pelos diálogos
+        unicos = {}
+        for channel, peso in canais:
+            unicos.setdefault(utils.get_peer_id(channel), (channel, peso))
+
+        # Outros processos com o mesmo manifesto: cada canal é arquivado por um só deles de cada vez
+        recursos = {}
+        arquivamentos = []
+        for peer_id, (channel, peso) in unicos.items():
+            recurso = f"canal:{peer_id}"
+            if not manifesto.arrendar(recurso, worker_id, lease_ttl):
+                evento(f"{nome_pasta(channel)} (ID: {channel.id}) já está sendo arquivado por outro processo, "
+                       f"pulando.", Fore.YELLOW)
+                continue
+            contas[0].entidades[peer_id] = channel
+            arquivamento = ArquivamentoCanal(channel, peso, selecao=selecao,
+                                             conta=await distribuir_canal(contas, channel))
+            recursos[recurso] = [arquivamento]
+            arquivamentos.append(arquivamento)
+        if not arquivamentos:
+            evento("Nenhum canal para arquivar.", nivel=logging.ERROR)
+            return []
 
+        # O handler é registrado antes da varredura para não perder o que for postado durante ela
+        filas = {utils.get_peer_id(a.channel): asyncio.Queue() for a in arquivamentos}
+        if acompanhar:
+            async def nova_mensagem(event):
+                fila = filas.get(event.chat_id)
+                if fila is not None:
+                    fila.put_nowait(event.message)
 
+            client.add_event_handler(nova_mensagem, events.NewMessage(chats=[a.channel for a in arquivamentos]))
+
+        evento(
+            f"Arquivando {len(arquivamentos)} canais com {len(contas)} conta(s) "
+            f"({sum(c.controlador.limite for c in contas)} downloads simultâneos, "
+            f"até {sum(c.controlador.limite_maximo for c in contas)})")
+        async with manter_arrendamentos(manifesto, recursos):
+            # Cada canal busca apenas mensagens mais novas que a última varredura concluída (min_id)
+            await arquivar_canais(client, arquivamentos, manifesto, controlador, contas)
+            escrever_resumo_lote(arquivamentos, controlador, arquivo_resumo, contas)
+
+            if acompanhar:
+                evento("Sincronização concluída, aguardando novas mídias...", Fore.GREEN)
+                ao_vivo = []
+                for a in arquivamentos:
+                    recurso = f"canal:{utils.get_peer_id(a.channel)}"
+                    if recurso not in recursos:
+                        continue
+                    ao_vivo.append(ArquivamentoCanal(
+                        a.channel, a.peso,
+                        mensagens=gerar_mensagens_novas(a.channel, manifesto, filas[utils.get_peer_id(a.channel)],
+                                                        a.selecao),
+                        selecao=a.selecao,
+                        conta=contas[0],
+                    ))
+                    recursos[recurso].append(ao_vivo[-1])
+                if ao_vivo:
+                    await arquivar_canais(client, ao_vivo, manifesto, controlador, contas)
+        return arquivamentos
+    finally:
+        manifesto.close()
+
+
+async def main_lote(args):
+    evento("Conectando ao Telegram...")
+    try:
+        async with contextlib.AsyncExitStack() as pilha:
+            await pilha.enter_async_context(servidor_metricas())
+            contas = []
+            for nome, id_conta, hash_conta in interpretar_sessoes(",".join(args.session) or sessions):
+                client = await pilha.enter_async_context(
+                    TelegramClient(nome, id_conta, hash_conta, flood_sleep_threshold=flood_sleep_threshold))
+                contas.append(ContaTelegram(nome, client))
+            evento(f"Conectado ao Telegram com sucesso! ({len(contas)} conta(s))", Fore.GREEN)
+            await arquivar_lote(
+                contas[0].client,
+                args.canais,
+                todos_dialogos=args.all_dialogs,
+                pesos=interpretar_pesos(args.weight),
+                acompanhar=getattr(args, "follow", False),
+                arquivo_resumo=args.summary,
+                selecao=interpretar_selecao(args),
+                contas=contas,
+            )
     except Exception as e:
-        print(f"{Fore.RED}Falha ao conectar, ocorreu um erro: {e}{Style.RESET_ALL}")
-        logger.error(f"Falha ao conectar: {e}")
+        evento(f"Falha ao arquivar, ocorreu um erro: {e}", nivel=logging.ERROR)
+
+
+def criar_parser():
+    parser = argparse.ArgumentParser(
+        description="Telegram Archiver downloader. Sem argumentos, abre o modo interativo."
+    )
+    subparsers = parser.add_subparsers(dest="comando")
+
+    canais = argparse.ArgumentParser(add_help=False)
+    canais.add_argument("canais", nargs="*", help="username, link ou ID de cada canal/grupo/usuário")
+    canais.add_argument(
+        "--all-dialogs", action="store_true", help="inclui todos os canais, grupos e usuários da conta"
+    )
+    canais.add_argument(
+        "--weight", action="append", default=[], metavar="CANAL=PESO",
+        help="arquivos por volta do round-robin para o canal (padrão 1); pode ser repetido",
+    )
+    canais.add_argument("--summary", metavar="ARQUIVO", help="caminho do resumo JSON por canal")
+    canais.add_argument(
+        "--session", action="append", default=[], metavar="SESSAO[:API_ID:API_HASH]",
+        help="conta usada no lote; pode ser repetido para dividir o trabalho entre contas (o mesmo que SESSIONS)",
+    )
+    canais.add_argument(
+        "--headless", action="store_true",
+        help="sem barra de progresso nem cores: eventos e resumos periódicos em JSON (o mesmo que HEADLESS=1)",
+    )
+    canais.add_argument(
+        "--types", metavar="TIPOS",
+        help=f"tipos de mídia separados por vírgula: {', '.join(FILTROS_MIDIA)} ou all (padrão all); "
+             "a filtragem é feita no servidor",
+    )
+    canais.add_argument("--min-size", type=float, metavar="MB", help="ignora mídias menores que MB")
+    canais.add_argument("--max-size", type=float, metavar="MB", help="ignora mídias maiores que MB")
+    canais.add_argument("--since", metavar="AAAA-MM-DD", help="somente mídias postadas a partir desta data")
+    canais.add_argument("--until", metavar="AAAA-MM-DD", help="somente mídias postadas até esta data (inclusive)")
+
+    subparsers.add_parser(
+        "batch", parents=[canais],
+        help="arquiva vários canais numa única conexão, dividindo os downloads entre eles",
+    )
+    sync = subparsers.add_parser(
+        "sync", parents=[canais], help="baixa somente as mídias novas dos canais informados, sem interação"
+    )
+    sync.add_argument(
+        "--follow", action="store_true",
+        help="depois de sincronizar, continua conectado baixando as novas mídias assim que forem postadas",
+    )
+    return parser
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = criar_parser()
+    args = parser.parse_args()
+    if args.comando in ("batch", "sync"):
+        if args.headless:
+            configurar_saida(True)
+        if not args.canais and not args.all_dialogs:
+            parser.error("informe ao menos um canal ou --all-dialogs")
+        try:
+            interpretar_selecao(args)
+            interpretar_sessoes(",".join(args.session) or sessions)
+        except ValueError as e:
+            parser.error(str(e))
+        asyncio.run(main_lote(args))
+    else:
+        asyncio.run(main())